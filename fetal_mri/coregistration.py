@@ -0,0 +1,159 @@
+"""
+FSL FLIRT co-registration of multi-echo images to a common reference echo.
+
+Registrations are content-addressed: the key is a hash of the moving and
+reference image contents plus the FLIRT arguments, and the resulting
+matrix and resampled image are kept in a cache directory. Re-running with
+the same inputs (e.g. to refit with different model settings) costs one
+hash per file and no FLIRT call; changing an input or an argument misses
+the cache. The independent echo registrations run concurrently.
+
+The registered images and matrices in <output_dir>/coregistered/ are hard
+links to the cache entries where the filesystem allows it, so treat them as
+read-only; the reference echo is copied there, never linked to the input.
+
+Shared by the T2* mapping scripts (main_estimate_t2star*.py).
+"""
+
+import os
+import shutil
+import hashlib
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+# 6-DOF rigid body, correlation ratio cost, sinc interpolation
+FLIRT_ARGS = (
+    '-dof', '6',
+    '-cost', 'corratio',
+    '-searchrx', '-30', '30',
+    '-searchry', '-30', '30',
+    '-searchrz', '-30', '30',
+    '-interp', 'sinc',
+)
+
+# Shared across output directories so a refit elsewhere still hits the cache
+DEFAULT_CACHE_DIR = os.environ.get(
+    'FLIRT_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'disc_mri', 'flirt'))
+
+
+def file_digest(path, block_size=1 << 22):
+    """SHA-256 hex digest of a file's contents."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def registration_key(in_digest, ref_digest, flirt_args):
+    """Cache key for registering one image (by content) to a reference."""
+    h = hashlib.sha256()
+    for part in (in_digest, ref_digest, *flirt_args):
+        h.update(part.encode())
+        h.update(b'\0')
+    return h.hexdigest()[:32]
+
+
+def _place(src, dst, link=True):
+    """Put a file at dst (hard link when possible and ``link``, else copy)."""
+    if link and os.path.exists(dst) and os.path.samefile(src, dst):
+        return
+    tmp = dst + '.tmp'
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    linked = False
+    if link:
+        try:
+            os.link(src, tmp)
+            linked = True
+        except OSError:
+            pass
+    if not linked:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+def flirt_cached(inp, ref_file, key, cache_dir, flirt_args=FLIRT_ARGS):
+    """
+    Register ``inp`` to ``ref_file`` unless ``key`` is already cached.
+
+    Returns (image_path, mat_path, hit) inside ``cache_dir``. FLIRT
+    writes to temporary names that are renamed into place only on
+    success, so an interrupted or concurrent run never leaves a partial
+    cache entry.
+    """
+    out_img = os.path.join(cache_dir, f'{key}.nii.gz')
+    out_mat = os.path.join(cache_dir, f'{key}.mat')
+    if os.path.exists(out_img) and os.path.exists(out_mat):
+        return out_img, out_mat, True
+
+    tmp_img = os.path.join(cache_dir, f'{key}.{os.getpid()}.tmp.nii.gz')
+    tmp_mat = os.path.join(cache_dir, f'{key}.{os.getpid()}.tmp.mat')
+    cmd = ['flirt', '-in', inp, '-ref', ref_file, '-out', tmp_img, '-omat', tmp_mat,
+           *flirt_args]
+    print(f"    CMD: {' '.join(cmd)}")
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    if result.returncode != 0:
+        print(f"    FLIRT STDERR: {result.stderr}")
+        raise RuntimeError(f"flirt failed for {inp}")
+    os.replace(tmp_mat, out_mat)
+    os.replace(tmp_img, out_img)
+    return out_img, out_mat, False
+
+
+def coregister_with_flirt(input_files, reference_idx, output_dir, cache_dir=None,
+                          flirt_args=FLIRT_ARGS, max_workers=None):
+    """
+    Coregister all images to a common reference using FSL flirt.
+
+    Parameters
+    ----------
+    input_files : list of str
+        Paths to input NIfTI files.
+    reference_idx : int
+        Index of the reference image (not registered, just copied).
+    output_dir : str
+        Directory for coregistered outputs and transform matrices.
+    cache_dir : str, optional
+        Content-addressed registration cache (default DEFAULT_CACHE_DIR).
+    flirt_args : tuple of str
+        FLIRT options; part of the cache key.
+    max_workers : int, optional
+        Concurrent FLIRT processes (default: one per moving image).
+
+    Returns
+    -------
+    coreg_files : list of str
+        Paths to the coregistered NIfTI files (in reference space).
+    """
+    coreg_dir = os.path.join(output_dir, 'coregistered')
+    cache_dir = cache_dir or DEFAULT_CACHE_DIR
+    os.makedirs(coreg_dir, exist_ok=True)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    ref_file = input_files[reference_idx]
+    ref_digest = file_digest(ref_file)
+
+    def register(i):
+        inp = input_files[i]
+        basename = os.path.basename(inp).replace('.nii.gz', '')
+        out_file = os.path.join(coreg_dir, f'{basename}_coreg.nii.gz')
+        omat_file = os.path.join(coreg_dir, f'{basename}_coreg.mat')
+
+        if i == reference_idx:
+            print(f"  [TE idx {i}] Reference image — copying: {os.path.basename(inp)}")
+            # a copy: a hard link would let in-place edits of the output reach the source data
+            _place(inp, out_file, link=False)
+            return out_file
+
+        key = registration_key(file_digest(inp), ref_digest, flirt_args)
+        print(f"  [TE idx {i}] Registering {os.path.basename(inp)} -> reference (key {key[:12]}) ...")
+        img, mat, hit = flirt_cached(inp, ref_file, key, cache_dir, flirt_args)
+        _place(img, out_file)
+        _place(mat, omat_file)
+        print(f"  [TE idx {i}] {'Cache hit' if hit else 'Done'} -> {os.path.basename(out_file)}")
+        return out_file
+
+    n_moving = len(input_files) - 1
+    with ThreadPoolExecutor(max_workers=max_workers or max(1, n_moving)) as pool:
+        return list(pool.map(register, range(len(input_files))))
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+In-process equivalent of ``flirt -applyxfm -init <mat>``.
+
+A FLIRT .mat maps the input image's "scaled voxel" coordinates to those of
+the reference. Scaled voxel coordinates are voxel indices multiplied by
+the voxel size, with the x axis flipped (x -> (nx - 1) - x) when the
+image's voxel-to-world matrix has a positive determinant (FSL convention).
+Composing the two scalings with the inverse transform gives the
+reference-voxel -> input-voxel matrix, and the input is sampled on the
+reference grid with vectorised trilinear (or nearest-neighbour)
+interpolation. Reference voxels that map outside the input are 0, as in
+FLIRT.
+"""
+
+import os
+
+import numpy as np
+import nibabel as nib
+
+# Reference voxels resampled per block (bounds the temporary coordinate arrays)
+DEFAULT_CHUNK_VOXELS = 1 << 21
+
+
+def read_flirt_mat(mat_path: str) -> np.ndarray:
+    """Load a 4x4 FLIRT matrix."""
+    mat = np.loadtxt(mat_path)
+    if mat.shape != (4, 4):
+        raise ValueError(f"Not a 4x4 FLIRT matrix: {mat_path}")
+    return mat
+
+
+def fsl_scaled_voxel_matrix(img) -> np.ndarray:
+    """Voxel index -> FSL scaled-voxel (mm) coordinates for ``img``."""
+    zooms = np.asarray(img.header.get_zooms()[:3], dtype=np.float64)
+    scale = np.diag([*zooms, 1.0])
+    if np.linalg.det(img.affine) > 0:
+        scale[0, 0] = -zooms[0]
+        scale[0, 3] = (img.shape[0] - 1) * zooms[0]
+    return scale
+
+
+def flirt_vox2vox(mat: np.ndarray, in_img, ref_img) -> np.ndarray:
+    """Reference voxel -> input voxel matrix for a FLIRT ``mat`` (input -> reference)."""
+    return (np.linalg.inv(fsl_scaled_voxel_matrix(in_img)) @ np.linalg.inv(mat)
+            @ fsl_scaled_voxel_matrix(ref_img))
+
+
+def _sample(data: np.ndarray, coords: np.ndarray, interp: str) -> np.ndarray:
+    """Sample ``data`` at voxel ``coords`` (3, n); 0 outside the volume."""
+    shape = np.asarray(data.shape[:3])
+    inside = np.all((coords >= 0) & (coords <= (shape - 1)[:, None]), axis=0)
+    out = np.zeros(coords.shape[1], dtype=data.dtype)
+    c = coords[:, inside]
+    flat = data.ravel()
+    strides = np.array([shape[1] * shape[2], shape[2], 1])
+
+    if interp == 'nearestneighbour':
+        idx = np.rint(c).astype(np.intp)
+        out[inside] = flat[strides @ idx]
+        return out
+
+    # Lower corner clipped so the upper corner stays inside; x = n - 1 gives weight 1
+    lo = np.minimum(np.floor(c).astype(np.intp), np.maximum(shape - 2, 0)[:, None])
+    frac = c - lo
+    hi = np.minimum(lo + 1, (shape - 1)[:, None])
+    acc = np.zeros(c.shape[1], dtype=np.float64)
+    for corner in range(8):
+        bits = [(corner >> k) & 1 for k in range(3)]
+        idx = strides[0] * (hi[0] if bits[0] else lo[0])
+        idx = idx + strides[1] * (hi[1] if bits[1] else lo[1])
+        idx = idx + (hi[2] if bits[2] else lo[2])
+        w = np.ones(c.shape[1])
+        for k in range(3):
+            w *= frac[k] if bits[k] else 1.0 - frac[k]
+        acc += w * flat[idx]
+    out[inside] = acc
+    return out
+
+
+def apply_flirt_xfm(in_img, ref_img, mat, interp: str = 'trilinear',
+                    out_path: str = None, dtype=np.float64,
+                    chunk_voxels: int = DEFAULT_CHUNK_VOXELS) -> np.ndarray:
+    """
+    Resample ``in_img`` onto the ``ref_img`` grid with a FLIRT transform.
+
+    Parameters
+    ----------
+    in_img, ref_img : nibabel image or str
+        Input and reference images (only the reference header is read).
+    mat : np.ndarray or str
+        FLIRT 4x4 matrix (input -> reference), or the path of a .mat file.
+    interp : {'trilinear', 'nearestneighbour'}
+    out_path : str, optional
+        Also write the result as NIfTI (reference geometry, like flirt -out).
+    dtype : numpy dtype
+        Output dtype (float64 matches ``get_fdata`` of a flirt output).
+
+    Returns
+    -------
+    np.ndarray
+        Resampled data with the reference image's 3D shape.
+    """
+    if interp not in ('trilinear', 'nearestneighbour'):
+        raise ValueError(f"Unsupported interpolation: {interp}")
+    if isinstance(in_img, str):
+        in_img = nib.load(in_img)
+    if isinstance(ref_img, str):
+        ref_img = nib.load(ref_img)
+    if isinstance(mat, str):
+        mat = read_flirt_mat(mat)
+
+    data = np.asarray(in_img.dataobj, dtype=np.float32 if interp == 'trilinear' else None)
+    if data.ndim > 3:
+        data = data.reshape(data.shape[:3])
+    vox2vox = flirt_vox2vox(np.asarray(mat, dtype=np.float64), in_img, ref_img)
+
+    nx, ny, nz = ref_img.shape[:3]
+    out = np.zeros((nx, ny, nz), dtype=dtype)
+    nz_chunk = max(1, chunk_voxels // max(1, nx * ny))
+    ii, jj = np.meshgrid(np.arange(nx), np.arange(ny), indexing='ij')
+    for z0 in range(0, nz, nz_chunk):
+        z1 = min(nz, z0 + nz_chunk)
+        kk = np.arange(z0, z1)
+        grid = np.stack([np.repeat(ii[..., None], z1 - z0, axis=2),
+                         np.repeat(jj[..., None], z1 - z0, axis=2),
+                         np.broadcast_to(kk, (nx, ny, z1 - z0))]).reshape(3, -1)
+        coords = vox2vox[:3, :3] @ grid + vox2vox[:3, 3:]
+        out[:, :, z0:z1] = _sample(data, coords, interp).reshape(nx, ny, z1 - z0)
+
+    if out_path:
+        out_img = nib.Nifti1Image(out, ref_img.affine, ref_img.header)
+        out_img.set_data_dtype(in_img.get_data_dtype())
+        tmp_path = out_path + f".{os.getpid()}.tmp.nii.gz"
+        nib.save(out_img, tmp_path)
+        os.replace(tmp_path, out_path)
+    return out
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Persistent per-volume metrics store for step 2 (SQLite under CACHE_DIR).
+
+One row per (subject, SVR volume) holds the six image-quality metrics plus
+everything they depend on: the input file's size, mtime and SHA-256, the
+SHA-256 of the step-1 transform and of the reference volume, and the
+metric-code version. A stored row is reused only if all of them still
+match; the input is re-hashed only when its size or mtime changed, so a
+touched but unchanged file is still a hit.
+
+The database runs in WAL mode so that step-2 workers can read while the
+main process writes the newly computed rows.
+"""
+
+import os
+import hashlib
+import sqlite3
+
+METRIC_COLUMNS = ('cr', 'cnr', 'snr_gm', 'snr_wm', 'ssim', 'nmse')
+
+_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS volume_metrics (
+    subject          TEXT    NOT NULL,
+    path             TEXT    NOT NULL,
+    size             INTEGER NOT NULL,
+    mtime_ns         INTEGER NOT NULL,
+    sha256           TEXT    NOT NULL,
+    transform_sha256 TEXT    NOT NULL,
+    reference_sha256 TEXT    NOT NULL,
+    metrics_version  INTEGER NOT NULL,
+    {', '.join(f'{m} REAL' for m in METRIC_COLUMNS)},
+    PRIMARY KEY (subject, path)
+)
+"""
+
+
+def file_digest(path: str, block_size: int = 1 << 22) -> str:
+    """SHA-256 hex digest of a file's contents."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class MetricsStore:
+    """SQLite-backed cache of per-volume metrics."""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(_SCHEMA)
+        self.conn.commit()
+
+    def lookup(self, subject: str, path: str, transform_sha256: str,
+               reference_sha256: str, metrics_version: int):
+        """
+        Return (metrics, row): ``metrics`` is the stored {metric: value}
+        if the entry is current, else None. ``row`` is the key part of a
+        row to store with the new metrics (hashes filled in), or, for a hit
+        whose mtime changed, the refreshed row to write back; None for a
+        plain hit.
+        """
+        st = os.stat(path)
+        cur = self.conn.execute(
+            f"SELECT size, mtime_ns, sha256, transform_sha256, reference_sha256, "
+            f"metrics_version, {', '.join(METRIC_COLUMNS)} FROM volume_metrics "
+            f"WHERE subject = ? AND path = ?", (subject, path))
+        stored = cur.fetchone()
+
+        if stored is not None and stored[:2] == (st.st_size, st.st_mtime_ns):
+            sha = stored[2]
+            touched = False
+        else:
+            sha = file_digest(path)
+            touched = True
+
+        row = {'subject': subject, 'path': path, 'size': st.st_size,
+               'mtime_ns': st.st_mtime_ns, 'sha256': sha,
+               'transform_sha256': transform_sha256,
+               'reference_sha256': reference_sha256,
+               'metrics_version': metrics_version}
+        if (stored is not None and stored[2] == sha
+                and stored[3:6] == (transform_sha256, reference_sha256, metrics_version)):
+            metrics = {m: (float('nan') if v is None else v)
+                       for m, v in zip(METRIC_COLUMNS, stored[6:])}
+            return metrics, (dict(row, **metrics) if touched else None)
+        return None, row
+
+    def put_many(self, rows) -> None:
+        """Insert or replace complete rows (key part plus the six metrics)."""
+        rows = list(rows)
+        if not rows:
+            return
+        columns = list(rows[0])
+        self.conn.executemany(
+            f"INSERT OR REPLACE INTO volume_metrics ({', '.join(columns)}) "
+            f"VALUES ({', '.join('?' for _ in columns)})",
+            [tuple(r[c] for c in columns) for r in rows])
+        self.conn.commit()
+
+    def close(self) -> None:
+        self.conn.close()
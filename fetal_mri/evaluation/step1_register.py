@@ -8,10 +8,16 @@ resulting .mat transform and aligned image are cached in CACHE_DIR so
 that step 2 can re-use them without re-running FLIRT.
 
 Run this script once before running step2_extract_metrics.py.
+Independent subject / TE registrations run in parallel with --jobs N;
+FLIRT writes to per-process temporary names that are renamed into place,
+so concurrent or interrupted runs never leave a partial cache entry.
 """
 
 import os
+import argparse
 import subprocess
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
 from tqdm import tqdm
 
 from config import (
@@ -21,6 +27,7 @@ from config import (
 
 
 def register_subject_te(subj_name: str, directory: str, pat_template: str, te: int) -> None:
+    """Register the max-stack SVR volume of one subject / TE to its atlas."""
     ga         = SUBJECT_GA.get(subj_name, 30)
     atlas_path = os.path.join(FETAL_ATLAS_DIR, f"STA{atlas_ga_str(ga)}.nii.gz")
 
@@ -44,20 +51,42 @@ def register_subject_te(subj_name: str, directory: str, pat_template: str, te: i
         return
 
     print(f"  [FLIRT] Registering {subj_name} TE {te} (max stacks={max_stacks}) ...")
+    # Temporary names only change the file name's suffix (CACHE_DIR may contain ".mat")
+    tmp_tag      = f"{os.getpid()}.tmp"
+    mat_root, mat_ext = os.path.splitext(ref_mat_path)
+    tmp_mat_path = f"{mat_root}.{tmp_tag}{mat_ext}"
+    tmp_img_path = f"{ref_aligned_path[:-len('.nii.gz')]}.{tmp_tag}.nii.gz"
     cmd = (
         f"flirt -in {ref_path} -ref {atlas_path} "
-        f"-omat {ref_mat_path} -out {ref_aligned_path} "
+        f"-omat {tmp_mat_path} -out {tmp_img_path} "
         f"-dof 6 -searchrx -180 180 -searchry -180 180 -searchrz -180 180 "
         f"-cost normmi"
     )
     subprocess.run(cmd, shell=True, check=True, stdout=subprocess.DEVNULL)
+    # The aligned image marks the entry as complete, so it is moved last
+    os.replace(tmp_mat_path, ref_mat_path)
+    os.replace(tmp_img_path, ref_aligned_path)
 
 
 def main() -> None:
-    print("Step 1: Computing all base FLIRT registrations ...")
-    for subj_name, (directory, pat_template) in tqdm(SUBJECTS.items(), desc="Subjects"):
-        for te in TE_VALUES:
-            register_subject_te(subj_name, directory, pat_template, te)
+    parser = argparse.ArgumentParser(description="Step 1: base FLIRT registrations")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="Number of subject/TE registrations run in parallel")
+    args = parser.parse_args()
+
+    units = [(subj_name, directory, pat_template, te)
+             for subj_name, (directory, pat_template) in SUBJECTS.items()
+             for te in TE_VALUES]
+    print(f"Step 1: Computing all base FLIRT registrations ({len(units)} subject/TE units, "
+          f"{args.jobs} worker(s)) ...")
+    if args.jobs > 1:
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            futures = {pool.submit(register_subject_te, *unit): unit for unit in units}
+            for fut in tqdm(as_completed(futures), total=len(futures), desc="Subject/TE"):
+                fut.result()
+    else:
+        for unit in tqdm(units, desc="Subject/TE"):
+            register_subject_te(*unit)
     print("Step 1 complete.  Registration files are cached in:", CACHE_DIR)
 
 
@@ -4,35 +4,54 @@ Step 2 – Apply transforms and extract image quality metrics.
 
 For every SVR volume found for each subject / TE / stack-count combination:
   1. Applies the cached FLIRT transform (from step 1) to align the volume
-     to the fetal atlas space.
+     to the fetal atlas space, in process (flirt_resample.py); the aligned
+     volume is only written to CACHE_DIR with --write-aligned.
   2. Computes CR, CNR, SNR-GM, SNR-WM, SSIM, and NMSE against the maximum-
      stack reference image.
   3. Aggregates per-subject metrics with outlier rejection.
   4. Saves the aggregated data to ``final_data.json`` (consumed by step 3)
      and summary text / JSON files.
 
+Per-volume metrics are kept in an SQLite store in CACHE_DIR, keyed by the
+input file, the transform, the reference volume and METRICS_VERSION; only
+missing or stale volumes are recomputed (--update re-extracts through the
+store instead of reusing all_data_raw.pkl / .json).
+
+Subject / TE units are independent; --jobs N processes them in parallel
+(results are merged in a fixed order, so the output does not depend on N).
+
 Prerequisites: run step1_register.py first.
 """
 
 import json
 import os
-import subprocess
 import pickle
 import argparse
+import functools
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import nibabel as nib
 import numpy as np
 from tqdm import tqdm
 
 from config import (
-    SUBJECTS, SUBJECT_GA, FETAL_ATLAS_DIR, CACHE_DIR, FINAL_DATA_JSON,
+    SUBJECTS, SUBJECT_GA, CACHE_DIR, FINAL_DATA_JSON,
     TE_VALUES, OUTLIER_REJECTION_RATE,
-    atlas_ga_str, get_subject_files, has_consecutive_stacks,
-    get_tissue_mask_for_subject, calculate_ssim_nmse, calculate_tissue_metrics,
+    get_subject_files, has_consecutive_stacks,
+    load_atlas_tissue, calculate_ssim_nmse, calculate_tissue_metrics,
 )
+from flirt_resample import apply_flirt_xfm, read_flirt_mat
+from metrics_store import MetricsStore, file_digest
 
 METRICS = ['cr', 'cnr', 'snr_gm', 'snr_wm', 'ssim', 'nmse']
 
+# Part of every metrics-store key: bump whenever calculate_tissue_metrics,
+# calculate_ssim_nmse or the resampling change, so stored values are recomputed.
+METRICS_VERSION = 2
+
+# Per-volume metrics store (see metrics_store.py); None disables it
+METRICS_DB = os.path.join(CACHE_DIR, "step2_metrics.sqlite")
+
 # Minimum number of subjects required to include a (TE, stack) data point
 MIN_SUBJECTS = 2
 
@@ -49,84 +68,163 @@ NMSE_MIN_TE: dict = {
 # If False, we keep all validated per-subject values (no ratio trimming).
 USE_PERCENTAGE_SELECTION = True
 
+# Also save each atlas-aligned volume as CACHE_DIR/<subj>_<name>_aligned.nii.gz
+# (metrics are computed from the in-memory resampling either way).
+WRITE_ALIGNED = False
+
 
 # ---------------------------------------------------------------------------
 # Phase 2a – apply cached transforms and compute per-iteration metrics
 # ---------------------------------------------------------------------------
 
-def extract_metrics_for_all_subjects() -> dict:
-    """Return raw per-subject/TE/stack metrics before aggregation."""
+@functools.lru_cache(maxsize=None)
+def _open_store(db_path: str) -> MetricsStore:
+    """Read connection to the metrics store; one per worker."""
+    return MetricsStore(db_path)
+
+
+def extract_metrics_for_unit(subj_name: str, directory: str, pat_template: str, te: int,
+                             write_aligned: bool = False, store_path: str = None):
+    """
+    Metrics of every SVR volume of one subject / TE.
+
+    With ``store_path``, volumes whose stored metrics are current are not
+    recomputed. Returns (log_lines, {stacks: {metric: [values]}}, rows),
+    where ``rows`` are the new or refreshed store rows for the caller to
+    write; the stack dict is empty if the unit is skipped. Runs in a
+    worker process with --jobs.
+    """
+    log: list = []
+    stack_files = get_subject_files(directory, pat_template, te)
+    if not stack_files or not has_consecutive_stacks(stack_files.keys()):
+        return log, {}, []
+
+    ref_aligned_path = os.path.join(CACHE_DIR, f"{subj_name}_te{te}_ref_aligned.nii.gz")
+    ref_mat_path     = os.path.join(CACHE_DIR, f"{subj_name}_te{te}_ref.mat")
+
+    if not os.path.exists(ref_aligned_path):
+        log.append(f"  [MISSING] TE {te}: run step1_register.py first")
+        return log, {}, []
+
+    store = _open_store(store_path) if store_path else None
+    try:
+        ref_mat = read_flirt_mat(ref_mat_path)
+        if store is not None:
+            transform_sha256 = file_digest(ref_mat_path)
+            reference_sha256 = file_digest(ref_aligned_path)
+    except (OSError, ValueError) as exc:
+        log.append(f"  [ERROR] TE {te}: {exc}")
+        return log, {}, []
+
+    stack_keys = sorted(stack_files.keys())
+    log.append(f"  TE {te}: stacks {stack_keys}, processing "
+               f"{sum(len(v) for v in stack_files.values())} volumes ...")
+
+    # Look every volume up first; the reference and atlas are only loaded
+    # if something has to be computed.
+    cached: dict = {}     # fpath -> stored metrics
+    key_rows: dict = {}   # fpath -> store key of a volume to (re)compute
+    rows: list = []
+    fpaths = [f for fpath_list in stack_files.values() for f in fpath_list]
+    for fpath in (fpaths if store is not None else []):
+        bname       = os.path.basename(fpath).replace(".nii.gz", "")
+        out_aligned = os.path.join(CACHE_DIR, f"{subj_name}_{bname}_aligned.nii.gz")
+        try:
+            metrics, row = store.lookup(subj_name, fpath, transform_sha256, reference_sha256,
+                                        METRICS_VERSION)
+        except OSError:
+            continue
+        if metrics is not None and (os.path.exists(out_aligned) or not write_aligned):
+            cached[fpath] = metrics
+            if row is not None:
+                rows.append(row)
+        else:
+            key_rows[fpath] = row
+
+    if len(cached) < len(fpaths):
+        try:
+            ref_data = nib.load(ref_aligned_path).get_fdata()  # type: ignore[attr-defined]
+            atlas    = load_atlas_tissue(SUBJECT_GA.get(subj_name, 30))
+        except (OSError, RuntimeError, ValueError) as exc:
+            log.append(f"  [ERROR] TE {te}: {exc}")
+            return log, {}, rows
+    if store is not None:
+        log.append(f"    {len(cached)} volume(s) from the metrics store, "
+                   f"{len(fpaths) - len(cached)} to compute")
+
+    unit: dict = {}
+    for stacks, fpath_list in stack_files.items():
+        bucket = unit.setdefault(stacks, {m: [] for m in METRICS})
+        for fpath in fpath_list:
+            metrics = cached.get(fpath)
+            if metrics is None:
+                bname       = os.path.basename(fpath).replace(".nii.gz", "")
+                out_aligned = os.path.join(CACHE_DIR, f"{subj_name}_{bname}_aligned.nii.gz")
+                try:
+                    img_data = apply_flirt_xfm(
+                        fpath, atlas.atlas_img, ref_mat,
+                        out_path=out_aligned if write_aligned else None)
+                    cr, cnr, s_gm, s_wm = calculate_tissue_metrics(img_data, atlas)
+                    ssim, nmse = calculate_ssim_nmse(img_data, ref_data)
+                except (OSError, RuntimeError, ValueError):
+                    continue
+                metrics = dict(zip(METRICS, map(float, (cr, cnr, s_gm, s_wm, ssim, nmse))))
+                if key_rows.get(fpath) is not None:
+                    rows.append(dict(key_rows[fpath], **metrics))
+            for m in METRICS:
+                bucket[m].append(metrics[m])
+    return log, unit, rows
+
+
+def extract_metrics_for_all_subjects(jobs: int = 1, store_path: str = None) -> dict:
+    """
+    Return raw per-subject/TE/stack metrics before aggregation.
+
+    Subject / TE units are independent and run on ``jobs`` worker
+    processes; results are merged in subject, TE order, so ``all_data``
+    is the same for any number of workers. With ``store_path`` only the
+    volumes missing from (or stale in) the metrics store are computed, and
+    the new results are written back by this process.
+    """
     all_data: dict = {te: {} for te in TE_VALUES}
     subject_list   = list(SUBJECTS.items())
     n_total        = len(subject_list)
-
-    for subj_idx, (subj_name, (directory, pat_template)) in enumerate(
-        tqdm(subject_list, desc="Extract metrics"), start=1
-    ):
-        ga         = SUBJECT_GA.get(subj_name, 30)
-        atlas_path = os.path.join(FETAL_ATLAS_DIR, f"STA{atlas_ga_str(ga)}.nii.gz")
-        print(f"\n[{subj_idx}/{n_total}] Subject: {subj_name} (GA={ga})")
-
-        for te in TE_VALUES:
-            stack_files = get_subject_files(directory, pat_template, te)
-            if not stack_files or not has_consecutive_stacks(stack_files.keys()):
-                continue
-
-            ref_aligned_path = os.path.join(CACHE_DIR, f"{subj_name}_te{te}_ref_aligned.nii.gz")
-            ref_mat_path     = os.path.join(CACHE_DIR, f"{subj_name}_te{te}_ref.mat")
-
-            if not os.path.exists(ref_aligned_path):
-                print(f"  [MISSING] TE {te}: run step1_register.py first")
-                continue
-
-            try:
-                ref_data    = nib.load(ref_aligned_path).get_fdata()  # type: ignore[attr-defined]
-                tissue_mask = get_tissue_mask_for_subject(subj_name)
-            except (OSError, RuntimeError, ValueError) as exc:
-                print(f"  [ERROR] TE {te}: {exc}")
-                continue
-
-            stack_keys = sorted(stack_files.keys())
-            print(f"  TE {te}: stacks {stack_keys}, processing {sum(len(v) for v in stack_files.values())} volumes ...")
-
-            for stacks, fpath_list in stack_files.items():
-                all_data[te].setdefault(stacks, {})
-                all_data[te][stacks].setdefault(
-                    subj_name,
-                    {m: [] for m in METRICS},
-                )
-                # Total subjects accumulated for this (te, stacks) bucket so far
-                n_subjs_in_bucket = len(all_data[te][stacks])
-                print(f"    stacks={stacks:2d}: {len(fpath_list)} combination(s), "
-                      f"total subjects in bucket so far: {n_subjs_in_bucket}")
-
-                for fpath in fpath_list:
-                    bname       = os.path.basename(fpath).replace(".nii.gz", "")
-                    out_aligned = os.path.join(CACHE_DIR,
-                                               f"{subj_name}_{bname}_aligned.nii.gz")
-
-                    try:
-                        if not os.path.exists(out_aligned):
-                            cmd = (f"flirt -in {fpath} -ref {atlas_path} "
-                                   f"-out {out_aligned} -applyxfm -init {ref_mat_path}")
-                            subprocess.run(cmd, shell=True, check=True,
-                                           stdout=subprocess.DEVNULL)
-
-                        img_data = nib.load(out_aligned).get_fdata()  # type: ignore[attr-defined]
-                        cr, cnr, s_gm, s_wm = calculate_tissue_metrics(img_data,
-                                                                        tissue_mask)
-                        ssim, nmse = calculate_ssim_nmse(img_data, ref_data)
-
-                        bucket = all_data[te][stacks][subj_name]
-                        bucket['cr'].append(cr)
-                        bucket['cnr'].append(cnr)
-                        bucket['snr_gm'].append(s_gm)
-                        bucket['snr_wm'].append(s_wm)
-                        bucket['ssim'].append(ssim)
-                        bucket['nmse'].append(nmse)
-                    except (OSError, RuntimeError, ValueError, subprocess.CalledProcessError):
-                        pass
-
+    units = [(subj_name, directory, pat_template, te)
+             for subj_name, (directory, pat_template) in subject_list
+             for te in TE_VALUES]
+    store = MetricsStore(store_path) if store_path else None
+
+    if jobs > 1:
+        results: dict = {}
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = {pool.submit(extract_metrics_for_unit, *unit, WRITE_ALIGNED, store_path): unit
+                       for unit in units}
+            for fut in tqdm(as_completed(futures), total=len(futures), desc="Extract metrics"):
+                results[futures[fut]] = fut.result()
+                if store is not None:
+                    store.put_many(results[futures[fut]][2])
+        unit_results = (results[unit] for unit in units)
+    else:
+        unit_results = (extract_metrics_for_unit(*unit, WRITE_ALIGNED, store_path)
+                        for unit in tqdm(units, desc="Extract metrics"))
+
+    subj_index = {name: i for i, (name, _) in enumerate(subject_list, start=1)}
+    for (subj_name, _, _, te), (log, unit, rows) in zip(units, unit_results):
+        if store is not None and jobs <= 1:
+            store.put_many(rows)
+        if te == TE_VALUES[0]:
+            print(f"\n[{subj_index[subj_name]}/{n_total}] Subject: {subj_name} "
+                  f"(GA={SUBJECT_GA.get(subj_name, 30)})")
+        for line in log:
+            print(line)
+        for stacks, metrics in unit.items():
+            all_data[te].setdefault(stacks, {})[subj_name] = metrics
+            # Total subjects accumulated for this (te, stacks) bucket so far
+            print(f"    stacks={stacks:2d}: {len(metrics['cr'])} volume(s) with metrics, "
+                  f"total subjects in bucket so far: {len(all_data[te][stacks])}")
+
+    if store is not None:
+        store.close()
     return all_data
 
 
@@ -433,7 +531,7 @@ def save_error_bar_json(final_data: dict) -> None:
 # ---------------------------------------------------------------------------
 
 def main() -> None:
-    global NMSE_MIN_GLOBAL, NMSE_MIN_TE, USE_PERCENTAGE_SELECTION, PER_SUBJECT_KEEP_RATIO, OVERALL_SUBJECT_KEEP_RATIO, MIN_SUBJECTS
+    global NMSE_MIN_GLOBAL, NMSE_MIN_TE, USE_PERCENTAGE_SELECTION, PER_SUBJECT_KEEP_RATIO, OVERALL_SUBJECT_KEEP_RATIO, MIN_SUBJECTS, WRITE_ALIGNED, METRICS_DB
     parser = argparse.ArgumentParser(description="Step 2: extract and aggregate metrics")
     parser.add_argument("--nmse-min-global", type=float, default=NMSE_MIN_GLOBAL,
                         help="Global minimum NMSE to accept (values <= this are dropped)")
@@ -447,6 +545,15 @@ def main() -> None:
                         help="Fraction of subjects to keep when percentage selection enabled")
     parser.add_argument("--min-subjects", type=int, default=MIN_SUBJECTS,
                         help="Minimum subjects required to report a stack/TE point")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="Number of subject/TE units extracted in parallel")
+    parser.add_argument("--write-aligned", action="store_true",
+                        help="Also save the atlas-aligned volumes to CACHE_DIR")
+    parser.add_argument("--update", action="store_true",
+                        help="Re-extract (computing only new or changed volumes) instead of "
+                             "reusing all_data_raw.pkl / .json")
+    parser.add_argument("--no-metrics-store", action="store_true",
+                        help="Recompute every volume and do not touch the metrics store")
     args = parser.parse_args()
 
     # Apply CLI overrides
@@ -465,6 +572,9 @@ def main() -> None:
     PER_SUBJECT_KEEP_RATIO = float(args.per_subject_keep_ratio)
     OVERALL_SUBJECT_KEEP_RATIO = float(args.overall_subject_keep_ratio)
     MIN_SUBJECTS = int(args.min_subjects)
+    WRITE_ALIGNED = bool(args.write_aligned)
+    if args.no_metrics_store:
+        METRICS_DB = None
     raw_json_path = os.path.join(
         os.path.dirname(FINAL_DATA_JSON),
         "all_data_raw.json",
@@ -475,7 +585,7 @@ def main() -> None:
     )
     
     all_data = None
-    if os.path.exists(raw_pkl_path):
+    if os.path.exists(raw_pkl_path) and not args.update:
         print(f"Step 2: Found {raw_pkl_path}. Reading data from Pickle instead of NIfTI files ...")
         try:
             with open(raw_pkl_path, "rb") as f:
@@ -484,7 +594,7 @@ def main() -> None:
             print(f"  [WARNING] Could not read Pickle ({e}). Falling back ...")
             all_data = None
             
-    if all_data is None and os.path.exists(raw_json_path):
+    if all_data is None and os.path.exists(raw_json_path) and not args.update:
         print(f"Step 2: Found {raw_json_path}. Reading data from JSON instead of NIfTI files ...")
         with open(raw_json_path, "r", encoding="utf-8") as f:
             serialisable = json.load(f)
@@ -503,7 +613,7 @@ def main() -> None:
                 all_data[te][s] = subj_dict
     elif all_data is None:
         print("Step 2: Applying transforms and extracting metrics ...")
-        all_data   = extract_metrics_for_all_subjects()
+        all_data   = extract_metrics_for_all_subjects(jobs=args.jobs, store_path=METRICS_DB)
 
     print("Step 2: Aggregating per-subject metrics (outlier rejection) ...")
     final_data = aggregate(all_data)
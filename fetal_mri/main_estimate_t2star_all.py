@@ -0,0 +1,352 @@
+"""
+Estimate T2*/S0/R2* maps for many fetal subjects in parallel.
+
+Subjects come from the SUBJECTS registry in evaluation/config.py (optionally
+extended by a JSON manifest). For each subject:
+  1. Pick the SVR volume with the most stacks per TE (same rule as
+     evaluation/step1_register.py).
+  2. Coregister all TEs to the TE=98 volume with FSL flirt.
+  3. Chunked log-linear + batched NLLS fit (relaxometry.py); zero voxels
+     inside the mask are filled with the local 3x3x3 median.
+  4. Save T2*, S0, R2* maps under <outdir>/<subject>/ (with --models, also
+     per-model parameter maps and AIC/BIC selection maps under
+     <outdir>/<subject>/model_selection/).
+  5. Summarise T2* per tissue. GM/WM labels come from the GA-matched atlas,
+     brought in through the step-1 FLIRT transform when it exists.
+
+Subjects whose maps are newer than all of their inputs, and whose fit
+settings (recorded in <outdir>/<subject>/t2star_settings.json) match the
+current ones, are not refitted; their statistics are recomputed from the
+saved maps. Results of all
+subjects are written to <outdir>/t2star_summary.tsv.
+
+Usage:
+    python main_estimate_t2star_all.py --jobs 4
+    python main_estimate_t2star_all.py --subjects subj_2_9_2026 subj_1_8_2026
+    python main_estimate_t2star_all.py --manifest extra_subjects.json
+    python main_estimate_t2star_all.py --models mono mono_offset rician_mono
+"""
+
+import os
+import sys
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import nibabel as nib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'evaluation'))
+from config import (  # noqa: E402
+    SUBJECTS, SUBJECT_GA, CACHE_DIR, OUTPUT_DIR, TE_VALUES,
+    get_subject_files, load_atlas_tissue,
+)
+from flirt_resample import apply_flirt_xfm  # noqa: E402
+from coregistration import coregister_with_flirt  # noqa: E402
+from relaxometry import (  # noqa: E402
+    MODELS, EchoSeries, fill_holes_median, fit_models_chunked, fit_t2star_chunked,
+    t2star_uncertainty_chunked,
+)
+
+# ============================================================
+# SETTINGS
+# ============================================================
+
+# TE used as the coregistration reference (and for the step-1 atlas transform)
+REFERENCE_TE = 98
+
+# T2* clipping range (ms) — SVR volumes include CSF with T2* well above 1000 ms
+T2STAR_MIN = 1.0
+T2STAR_MAX = 2000.0
+
+MAP_NAMES = ('T2star_map.nii.gz', 'S0_map.nii.gz', 'R2star_map.nii.gz')
+UNCERTAINTY_NAMES = {
+    't2star_se': 'T2star_SE_map.nii.gz',
+    's0_se': 'S0_SE_map.nii.gz',
+    't2star_ci_low': 'T2star_CI_low.nii.gz',
+    't2star_ci_high': 'T2star_CI_high.nii.gz',
+}
+MODEL_SELECTION_DIR = 'model_selection'
+# Records the options the maps were fitted with; bump FIT_VERSION when the
+# fitting code changes its output so that saved maps are refitted
+SETTINGS_NAME = 't2star_settings.json'
+FIT_VERSION = 1
+SUMMARY_COLUMNS = ['subject', 'ga', 'status', 'tissue', 'n_voxels',
+                   'median', 'mean', 'std', 'p25', 'p75']
+
+
+# ============================================================
+# PER-SUBJECT WORK
+# ============================================================
+
+def select_inputs(directory, pat_template):
+    """Return the max-stack SVR file for each TE, or None if any TE is missing."""
+    files = []
+    for te in TE_VALUES:
+        stack_files = get_subject_files(directory, pat_template, te)
+        if not stack_files:
+            return None
+        files.append(stack_files[max(stack_files.keys())][0])
+    return files
+
+
+def fit_settings(input_paths, refine=True, uncertainty=None, models=None):
+    """Everything besides the input data that the saved maps depend on."""
+    return {'version': FIT_VERSION, 'inputs': [os.path.abspath(p) for p in input_paths],
+            'reference_te': REFERENCE_TE, 't2star_range': [T2STAR_MIN, T2STAR_MAX],
+            'refine': bool(refine), 'uncertainty': uncertainty,
+            'models': list(models) if models else None}
+
+
+def outputs_up_to_date(out_paths, input_paths, settings_path, settings):
+    """
+    True if every output exists and is newer than every input, and the
+    settings recorded in ``settings_path`` equal ``settings``.
+    """
+    if not all(os.path.exists(p) for p in out_paths):
+        return False
+    newest_input = max(os.path.getmtime(p) for p in input_paths)
+    if min(os.path.getmtime(p) for p in out_paths) <= newest_input:
+        return False
+    try:
+        with open(settings_path, 'r', encoding='utf-8') as f:
+            return json.load(f) == settings
+    except (OSError, ValueError):
+        return False
+
+
+def write_settings(settings_path, settings):
+    """Record the fit settings (atomically, after all maps are saved)."""
+    tmp_path = f"{settings_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(settings, f, indent=2)
+    os.replace(tmp_path, settings_path)
+
+
+def fit_subject_maps(coreg_files, out_paths, refine=True, uncertainty=None, models=None):
+    """
+    Fit and save T2*, S0 and R2* maps (plus the uncertainty maps, written
+    next to them, if ``uncertainty`` is 'analytic' or 'bootstrap', and the
+    model-selection maps if ``models`` lists registered models); return
+    the T2* map and brain mask.
+    """
+    echoes = EchoSeries(coreg_files)
+    t2star_map, s0_map, brain_mask = fit_t2star_chunked(
+        echoes, np.asarray(TE_VALUES, dtype=float),
+        mask_fn=lambda slab: np.all(slab > 0, axis=-1),
+        t2star_min=T2STAR_MIN, t2star_max=T2STAR_MAX,
+        refine=refine, no_decay_value=T2STAR_MAX,
+    )
+    t2star_map[(t2star_map < T2STAR_MIN) | (t2star_map > T2STAR_MAX)] = 0
+    if uncertainty:
+        subj_dir = os.path.dirname(out_paths[0])
+        for name, data in t2star_uncertainty_chunked(
+                echoes, np.asarray(TE_VALUES, dtype=float), t2star_map, s0_map,
+                method=uncertainty, t2star_min=T2STAR_MIN, t2star_max=T2STAR_MAX).items():
+            nib.save(nib.Nifti1Image(data, echoes.affine, echoes.header),
+                     os.path.join(subj_dir, UNCERTAINTY_NAMES[name]))
+    if models:
+        sel_dir = os.path.join(os.path.dirname(out_paths[0]), MODEL_SELECTION_DIR)
+        os.makedirs(sel_dir, exist_ok=True)
+        for name, data in fit_models_chunked(
+                echoes, np.asarray(TE_VALUES, dtype=float),
+                mask_fn=lambda slab: np.all(slab > 0, axis=-1),
+                models=models, t2star_min=T2STAR_MIN).items():
+            img = nib.Nifti1Image(data, echoes.affine, echoes.header)
+            img.set_data_dtype(data.dtype)
+            nib.save(img, os.path.join(sel_dir, f'{name}.nii.gz'))
+    fill_holes_median([t2star_map, s0_map], brain_mask)
+
+    # R2* = 1000 / T2* (in s^-1, with T2* in ms)
+    r2star_map = np.zeros_like(t2star_map)
+    valid = t2star_map > 0
+    r2star_map[valid] = 1000.0 / t2star_map[valid]
+
+    for data, path in zip((t2star_map, s0_map, r2star_map), out_paths):
+        nib.save(nib.Nifti1Image(data, echoes.affine, echoes.header), path)
+    return t2star_map, brain_mask
+
+
+def t2star_in_atlas_space(subj_name, t2star_path, subj_dir):
+    """
+    Resample the T2* map into atlas space with the step-1 transform and
+    return (t2star_in_atlas, atlas), where ``atlas`` is the cached
+    AtlasTissue of the subject's GA, or None if the transform is not
+    available.
+    """
+    mat_path = os.path.join(CACHE_DIR, f"{subj_name}_te{REFERENCE_TE}_ref.mat")
+    if not os.path.exists(mat_path):
+        return None
+    atlas = load_atlas_tissue(SUBJECT_GA.get(subj_name, 30))
+    out_path = os.path.join(subj_dir, 'T2star_map_atlas.nii.gz')
+    t2_atlas = apply_flirt_xfm(t2star_path, atlas.atlas_img, mat_path,
+                               interp='nearestneighbour', out_path=out_path, dtype=np.float32)
+    return t2_atlas, atlas
+
+
+def t2star_stats(values):
+    """Summary statistics of the positive T2* values in ``values``."""
+    v = values[values > 0]
+    if v.size == 0:
+        return {'n_voxels': 0, 'median': np.nan, 'mean': np.nan, 'std': np.nan,
+                'p25': np.nan, 'p75': np.nan}
+    p25, med, p75 = np.percentile(v, [25, 50, 75])
+    return {'n_voxels': int(v.size), 'median': float(med), 'mean': float(v.mean()),
+            'std': float(v.std()), 'p25': float(p25), 'p75': float(p75)}
+
+
+def process_subject(subj_name, directory, pat_template, out_root, refine=True, force=False,
+                    uncertainty=None, models=None):
+    """
+    Fit one subject (unless up to date) and return its summary rows.
+
+    Runs in a worker process; everything it needs is passed explicitly.
+    """
+    ga = SUBJECT_GA.get(subj_name, 30)
+    row = {'subject': subj_name, 'ga': ga}
+
+    input_files = select_inputs(directory, pat_template)
+    if input_files is None:
+        return [dict(row, status='missing', tissue='brain', **t2star_stats(np.zeros(0)))]
+
+    subj_dir = os.path.join(out_root, subj_name)
+    os.makedirs(subj_dir, exist_ok=True)
+    out_paths = [os.path.join(subj_dir, name) for name in MAP_NAMES]
+    expected = out_paths + ([os.path.join(subj_dir, name) for name in UNCERTAINTY_NAMES.values()]
+                            if uncertainty else [])
+    if models:
+        expected += [os.path.join(subj_dir, MODEL_SELECTION_DIR, f'{name}.nii.gz')
+                     for name in ('best_aic', 'best_bic')]
+
+    settings_path = os.path.join(subj_dir, SETTINGS_NAME)
+    settings = fit_settings(input_files, refine=refine, uncertainty=uncertainty, models=models)
+
+    if not force and outputs_up_to_date(expected, input_files, settings_path, settings):
+        status = 'cached'
+        t2star_map = np.asarray(nib.load(out_paths[0]).dataobj, dtype=np.float32)
+        brain_mask = t2star_map > 0
+    else:
+        status = 'fitted'
+        # an interrupted refit must not leave the old settings next to new maps
+        if os.path.exists(settings_path):
+            os.remove(settings_path)
+        ref_idx = TE_VALUES.index(REFERENCE_TE)
+        coreg_files = coregister_with_flirt(input_files, ref_idx, subj_dir,
+                                            cache_dir=os.path.join(CACHE_DIR, 'flirt_coreg'))
+        t2star_map, brain_mask = fit_subject_maps(coreg_files, out_paths, refine=refine,
+                                                  uncertainty=uncertainty, models=models)
+        write_settings(settings_path, settings)
+
+    rows = [dict(row, status=status, tissue='brain', **t2star_stats(t2star_map[brain_mask]))]
+
+    try:
+        atlas_space = t2star_in_atlas_space(subj_name, out_paths[0], subj_dir)
+    except (OSError, ValueError) as exc:
+        print(f"  [{subj_name}] tissue statistics unavailable: {exc}")
+        atlas_space = None
+    if atlas_space is not None:
+        t2_atlas, atlas = atlas_space
+        for tissue_name, index in (('gm', atlas.gm_index), ('wm', atlas.wm_index)):
+            rows.append(dict(row, status=status, tissue=tissue_name,
+                             **t2star_stats(t2_atlas.reshape(-1)[index])))
+    return rows
+
+
+# ============================================================
+# SUMMARY
+# ============================================================
+
+def write_summary(rows, path):
+    """Write the combined per-subject, per-tissue table as TSV."""
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('\t'.join(SUMMARY_COLUMNS) + '\n')
+        for r in rows:
+            f.write('\t'.join(
+                f"{r[c]:.2f}" if isinstance(r[c], float) else str(r[c])
+                for c in SUMMARY_COLUMNS) + '\n')
+
+
+def print_summary(rows):
+    print(f"\n{'Subject':<24} {'GA':>3} {'Status':<8} {'Tissue':<6} {'N':>9} "
+          f"{'Median':>8} {'Mean':>8} {'Std':>8} {'IQR':>17}")
+    print('-' * 98)
+    for r in rows:
+        print(f"{r['subject']:<24} {r['ga']:>3} {r['status']:<8} {r['tissue']:<6} "
+              f"{r['n_voxels']:>9} {r['median']:>8.1f} {r['mean']:>8.1f} {r['std']:>8.1f} "
+              f"{r['p25']:>8.1f}-{r['p75']:<8.1f}")
+
+
+# ============================================================
+# MAIN
+# ============================================================
+
+def load_manifest(path):
+    """Read {subject: [directory, pattern]} entries from a JSON manifest."""
+    with open(path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    return {name: tuple(entry) for name, entry in manifest.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Multi-subject T2*/R2* mapping")
+    parser.add_argument('--subjects', nargs='+', default=None,
+                        help="Subject names to process (default: all registered subjects)")
+    parser.add_argument('--manifest', default=None,
+                        help="JSON file of extra/overriding {subject: [svr_dir, pattern]} entries")
+    parser.add_argument('--outdir', default=os.path.join(OUTPUT_DIR, 't2star_maps'),
+                        help="Root directory for per-subject maps and the summary table")
+    parser.add_argument('--jobs', type=int, default=1,
+                        help="Number of subjects fitted in parallel")
+    parser.add_argument('--no-nlls', action='store_true',
+                        help="Log-linear fit only (skip the NLLS refinement)")
+    parser.add_argument('--uncertainty', choices=['analytic', 'bootstrap'], default=None,
+                        help="Also write per-voxel T2*/S0 standard error and T2* CI maps")
+    parser.add_argument('--models', nargs='+', choices=list(MODELS), default=None,
+                        help="Also fit these decay models and write per-voxel AIC/BIC "
+                             "model-selection maps (best_aic/best_bic are 1-based indices "
+                             "into this list)")
+    parser.add_argument('--force', action='store_true',
+                        help="Refit even if the maps are up to date")
+    args = parser.parse_args()
+
+    registry = dict(SUBJECTS)
+    if args.manifest:
+        registry.update(load_manifest(args.manifest))
+    names = args.subjects or list(registry)
+    unknown = [n for n in names if n not in registry]
+    if unknown:
+        parser.error(f"unknown subject(s): {', '.join(unknown)}")
+
+    os.makedirs(args.outdir, exist_ok=True)
+    print(f"Fitting {len(names)} subject(s) with {args.jobs} worker(s) -> {args.outdir}")
+
+    results = {}
+    if args.jobs > 1:
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            futures = {
+                pool.submit(process_subject, n, *registry[n], args.outdir,
+                            not args.no_nlls, args.force, args.uncertainty,
+                            args.models): n
+                for n in names
+            }
+            for fut in as_completed(futures):
+                n = futures[fut]
+                results[n] = fut.result()
+                print(f"  [{len(results)}/{len(names)}] {n}: {results[n][0]['status']}")
+    else:
+        for n in names:
+            results[n] = process_subject(n, *registry[n], args.outdir,
+                                         not args.no_nlls, args.force, args.uncertainty,
+                                         args.models)
+            print(f"  [{len(results)}/{len(names)}] {n}: {results[n][0]['status']}")
+
+    # Keep the table in manifest order regardless of completion order
+    rows = [r for n in names for r in results[n]]
+    summary_path = os.path.join(args.outdir, 't2star_summary.tsv')
+    write_summary(rows, summary_path)
+    print_summary(rows)
+    print(f"\nSummary table: {summary_path}")
+
+
+if __name__ == '__main__':
+    main()
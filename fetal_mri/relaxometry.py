@@ -0,0 +1,825 @@
+"""
+Vectorised voxel-wise relaxometry fitting for multi-echo fetal MRI.
+
+Model: S(TE) = S0 * exp(-TE * R2*),  T2* = 1 / R2*
+
+All voxels are fitted at once: the Levenberg-Marquardt solver below keeps a
+damping parameter per voxel and solves the 2x2 normal equations of every
+voxel in closed form, so there is no Python-level loop over voxels. Bounds
+are enforced by projecting each trial step onto the feasible box.
+
+The chunked engine (fit_t2star_chunked) reads the echoes lazily through
+nibabel's array proxies in z-slabs of bounded size, fits only masked voxels
+and writes straight into preallocated float32 maps, so peak memory depends
+on the chunk size rather than on the volume size.
+
+Other decay models (mono + offset, bi-exponential, Rician noise floor) are
+registered in MODELS with vectorised predict/Jacobian functions and share
+the n-parameter batched solver fit_model; fit_models_chunked fits several
+of them and writes per-voxel AIC/BIC model-selection maps.
+
+t2star_uncertainty_chunked adds per-voxel standard errors and confidence
+intervals, either analytically from the Jacobian or by a residual
+bootstrap that refits all voxels x replicates in one batched LM call.
+
+fill_holes_median patches the zero voxels left inside the mask using only
+the hole voxels and their 3x3x3 neighbourhoods.
+
+Used by main_estimate_t2star.py and the per-scan copies in scan_*/.
+"""
+
+import numpy as np
+import nibabel as nib
+from scipy.stats import t as student_t
+
+# Voxels per z-slab read from disk; bounds the working memory of the engine
+DEFAULT_CHUNK_VOXELS = 1 << 20
+
+
+# ============================================================
+# MODEL
+# ============================================================
+
+def mono_exponential(te, s0, r2star):
+    """Mono-exponential decay: S = S0 * exp(-TE * R2*)."""
+    return s0 * np.exp(-te * r2star)
+
+
+def loglinear_mono(signal, te_values):
+    """
+    Log-linear least-squares fit ln(S) = ln(S0) - TE * R2* for many voxels.
+
+    Parameters
+    ----------
+    signal : np.ndarray, shape (n_voxels, n_echoes)
+        Strictly positive signal.
+    te_values : np.ndarray, shape (n_echoes,)
+
+    Returns
+    -------
+    s0 : np.ndarray, shape (n_voxels,)
+    r2star : np.ndarray, shape (n_voxels,)
+        Negative where the signal does not decay.
+    """
+    A = np.column_stack([np.ones(len(te_values)), te_values])
+    params = np.log(signal) @ np.linalg.pinv(A).T
+    return np.exp(params[:, 0]), -params[:, 1]
+
+
+def _mono_cost(y, te, s0, r2star):
+    """Per-voxel sum of squared residuals, shape (n_voxels,)."""
+    res = y - s0[:, None] * np.exp(-te[None, :] * r2star[:, None])
+    return np.einsum('ij,ij->i', res, res)
+
+
+# ============================================================
+# BATCHED LEVENBERG-MARQUARDT
+# ============================================================
+
+def fit_mono_exponential(signal, te_values, s0_init, r2star_init,
+                         r2star_max=np.inf, max_iter=500, tol=1e-10,
+                         lam_init=1e-3, lam_max=1e10):
+    """
+    Fit S0 and R2* for many voxels simultaneously with Levenberg-Marquardt.
+
+    Each voxel has its own damping parameter lam. A step solves
+    (J^T J + lam * diag(J^T J)) dp = J^T r with the 2x2 system inverted in
+    closed form, is projected onto 0 <= S0, 0 <= R2* <= r2star_max, and is
+    accepted only where it lowers that voxel's cost (lam /= 10), otherwise
+    rejected (lam *= 10). Voxels drop out of the active set once the
+    relative cost decrease falls below ``tol`` or lam exceeds ``lam_max``.
+
+    Parameters
+    ----------
+    signal : np.ndarray, shape (n_voxels, n_echoes)
+    te_values : np.ndarray, shape (n_echoes,)
+    s0_init, r2star_init : np.ndarray, shape (n_voxels,)
+        Starting point, typically the log-linear estimates.
+    r2star_max : float
+        Upper bound on R2* (1 / T2STAR_MIN).
+    max_iter : int
+        Maximum number of LM iterations.
+    tol : float
+        Relative cost decrease below which a voxel counts as converged.
+
+    Returns
+    -------
+    s0 : np.ndarray, shape (n_voxels,)
+    r2star : np.ndarray, shape (n_voxels,)
+    n_iter : int
+        Number of iterations run.
+    """
+    y = np.asarray(signal, dtype=np.float64)
+    te = np.asarray(te_values, dtype=np.float64)
+    s0 = np.clip(np.asarray(s0_init, dtype=np.float64), 0.0, None).copy()
+    r2 = np.clip(np.asarray(r2star_init, dtype=np.float64), 0.0, r2star_max).copy()
+
+    n = y.shape[0]
+    lam = np.full(n, lam_init)
+    cost = _mono_cost(y, te, s0, r2)
+    active = np.arange(n)
+
+    it = 0
+    for it in range(1, max_iter + 1):
+        if active.size == 0:
+            break
+        ya, s0a, r2a, la = y[active], s0[active], r2[active], lam[active]
+
+        # Residuals and Jacobian columns: dS/dS0 = e, dS/dR2* = -TE * S0 * e
+        e = np.exp(-te[None, :] * r2a[:, None])
+        res = ya - s0a[:, None] * e
+        j0 = e
+        j1 = -te[None, :] * s0a[:, None] * e
+
+        # Per-voxel 2x2 normal equations
+        a = np.einsum('ij,ij->i', j0, j0)
+        b = np.einsum('ij,ij->i', j0, j1)
+        c = np.einsum('ij,ij->i', j1, j1)
+        g0 = np.einsum('ij,ij->i', j0, res)
+        g1 = np.einsum('ij,ij->i', j1, res)
+
+        ad = a * (1.0 + la) + 1e-30
+        cd = c * (1.0 + la) + 1e-30
+        det = ad * cd - b * b
+        ok = det > 0
+        det = np.where(ok, det, 1.0)
+        d0 = np.where(ok, (cd * g0 - b * g1) / det, 0.0)
+        d1 = np.where(ok, (ad * g1 - b * g0) / det, 0.0)
+
+        # Projected trial step. Where R2* hits a bound, S0 is re-solved in
+        # closed form on that face (the model is linear in S0) instead of
+        # keeping the unconstrained S0 step, which belongs to the wrong R2*.
+        s0_new = np.maximum(s0a + d0, 0.0)
+        r2_step = r2a + d1
+        r2_new = np.clip(r2_step, 0.0, r2star_max)
+        clamped = r2_new != r2_step
+        if clamped.any():
+            ec = np.exp(-te[None, :] * r2_new[clamped, None])
+            s0_new[clamped] = np.maximum(
+                np.einsum('ij,ij->i', ya[clamped], ec)
+                / np.maximum(np.einsum('ij,ij->i', ec, ec), 1e-300), 0.0)
+        cost_old = cost[active]
+        cost_new = _mono_cost(ya, te, s0_new, r2_new)
+
+        accept = ok & (cost_new < cost_old)
+        idx = active[accept]
+        s0[idx] = s0_new[accept]
+        r2[idx] = r2_new[accept]
+        cost[idx] = cost_new[accept]
+        lam[active] = np.where(accept, la * 0.1, la * 10.0)
+
+        rel = (cost_old - cost_new) / np.maximum(cost_old, 1e-300)
+        done = (accept & (rel < tol)) | (lam[active] > lam_max) | (cost[active] == 0)
+        active = active[~done]
+
+    return s0, r2, it
+
+
+# ============================================================
+# CHUNKED ENGINE
+# ============================================================
+
+class EchoSeries:
+    """
+    Lazily read multi-echo data, either one 3D NIfTI per echo or a single
+    4D NIfTI with echoes along the last axis.
+
+    Nothing is loaded on construction: slab() reads the requested z-range
+    of every echo through nibabel's array proxy (memory-mapped for
+    uncompressed files).
+    """
+
+    def __init__(self, paths):
+        if isinstance(paths, str):
+            paths = [paths]
+        self.images = [nib.load(p, mmap=True) for p in paths]
+        self.sources = []
+        for img in self.images:
+            if len(img.shape) == 4:
+                self.sources += [(img.dataobj, k) for k in range(img.shape[3])]
+            else:
+                self.sources.append((img.dataobj, None))
+        self.shape = tuple(self.images[0].shape[:3])
+        for img in self.images[1:]:
+            if tuple(img.shape[:3]) != self.shape:
+                raise ValueError(f"Echo shape {img.shape[:3]} does not match {self.shape}")
+        self.affine = self.images[0].affine
+        self.header = self.images[0].header
+
+    @property
+    def n_echoes(self):
+        return len(self.sources)
+
+    def slab(self, z0, z1):
+        """Return echoes for z in [z0, z1) as float32, shape (nx, ny, dz, n_echoes)."""
+        out = np.empty(self.shape[:2] + (z1 - z0, self.n_echoes), dtype=np.float32)
+        for e, (proxy, k) in enumerate(self.sources):
+            out[..., e] = proxy[:, :, z0:z1] if k is None else proxy[:, :, z0:z1, k]
+        return out
+
+
+def iter_slabs(shape, chunk_voxels=DEFAULT_CHUNK_VOXELS):
+    """Yield (z0, z1) ranges covering shape[2] with at most ~chunk_voxels voxels each."""
+    dz = max(1, chunk_voxels // max(1, shape[0] * shape[1]))
+    for z0 in range(0, shape[2], dz):
+        yield z0, min(z0 + dz, shape[2])
+
+
+def max_mean_signal(echoes, chunk_voxels=DEFAULT_CHUNK_VOXELS):
+    """Maximum over voxels of the echo-averaged signal, computed slab by slab."""
+    vmax = -np.inf
+    for z0, z1 in iter_slabs(echoes.shape, chunk_voxels):
+        vmax = max(vmax, float(echoes.slab(z0, z1).mean(axis=-1).max()))
+    return vmax
+
+
+def fit_t2star_chunked(echoes, te_values, mask_fn, t2star_min=1.0, t2star_max=500.0,
+                       refine=True, no_decay_value=0.0,
+                       chunk_voxels=DEFAULT_CHUNK_VOXELS, out=None):
+    """
+    Voxel-wise T2*/S0 estimation, one z-slab at a time.
+
+    For every slab the echoes are read, ``mask_fn`` selects the voxels to
+    fit, the log-linear fit provides T2* and S0 and, if ``refine``, voxels
+    with t2star_min < T2* < t2star_max are refined with
+    fit_mono_exponential. Results are written into float32 maps.
+
+    Masked voxels with a non-positive echo are left at 0. Voxels whose
+    log-linear slope shows no decay get ``no_decay_value``.
+
+    Parameters
+    ----------
+    echoes : EchoSeries
+    te_values : np.ndarray, shape (n_echoes,)
+        Echo times in milliseconds.
+    mask_fn : callable
+        Maps a slab of shape (nx, ny, dz, n_echoes) to a boolean mask of
+        shape (nx, ny, dz).
+    t2star_min, t2star_max : float
+        Valid T2* range (ms) for NLLS refinement; 1 / t2star_min bounds R2*.
+    refine : bool
+        Run the batched NLLS refinement after the log-linear fit.
+    no_decay_value : float
+        T2* assigned where the signal does not decay.
+    chunk_voxels : int
+        Approximate number of voxels per slab.
+    out : tuple of (t2star_map, s0_map, mask), optional
+        Preallocated outputs (e.g. np.memmap); float32, float32 and bool
+        arrays of the echo shape.
+
+    Returns
+    -------
+    t2star_map : np.ndarray, shape (nx, ny, nz), float32
+    s0_map : np.ndarray, shape (nx, ny, nz), float32
+    mask : np.ndarray, shape (nx, ny, nz), bool
+    """
+    te = np.asarray(te_values, dtype=np.float64)
+    if len(te) != echoes.n_echoes:
+        raise ValueError(f"{len(te)} TE values for {echoes.n_echoes} echoes")
+    if out is None:
+        out = (np.zeros(echoes.shape, dtype=np.float32),
+               np.zeros(echoes.shape, dtype=np.float32),
+               np.zeros(echoes.shape, dtype=bool))
+    t2star_map, s0_map, mask = out
+
+    for z0, z1 in iter_slabs(echoes.shape, chunk_voxels):
+        slab = echoes.slab(z0, z1)
+        m = mask_fn(slab)
+        mask[:, :, z0:z1] = m
+
+        y = slab[m].astype(np.float64)
+        t2 = np.zeros(len(y))
+        s0 = np.zeros(len(y))
+
+        fit = np.all(y > 0, axis=1)
+        s0_fit, r2_fit = loglinear_mono(y[fit], te)
+        t2_fit = np.full(len(r2_fit), no_decay_value)
+        decay = r2_fit > 0
+        t2_fit[decay] = 1.0 / r2_fit[decay]
+
+        if refine:
+            sel = (t2_fit > t2star_min) & (t2_fit < t2star_max) & (s0_fit > 0)
+            s0_ref, r2_ref, _ = fit_mono_exponential(
+                y[fit][sel], te, s0_fit[sel], 1.0 / t2_fit[sel],
+                r2star_max=1.0 / t2star_min)
+            s0_fit[sel] = s0_ref
+            t2_fit[sel] = np.divide(1.0, r2_ref, out=np.zeros_like(r2_ref),
+                                    where=r2_ref > 0)
+
+        t2[fit] = t2_fit
+        s0[fit] = s0_fit
+        t2star_map[:, :, z0:z1][m] = t2
+        s0_map[:, :, z0:z1][m] = s0
+
+    return t2star_map, s0_map, mask
+
+
+# ============================================================
+# MODEL REGISTRY
+# ============================================================
+
+class RelaxationModel:
+    """
+    A signal model S(TE; p) with vectorised prediction and Jacobian.
+
+    ``predict(p, te)`` returns (n_voxels, n_echoes), ``jacobian(p, te)``
+    returns (n_voxels, n_echoes, n_params), ``init(y, te, s0, r2star)``
+    maps log-linear estimates to a starting point (n_voxels, n_params) and
+    ``upper(r2star_max)`` gives the parameter upper bounds (all lower
+    bounds are 0). ``t2star(p)`` is the T2* reported for the model.
+    """
+
+    def __init__(self, name, param_names, predict, jacobian, init, upper, t2star,
+                 canonical=None):
+        self.name = name
+        self.param_names = tuple(param_names)
+        self.predict = predict
+        self.jacobian = jacobian
+        self.init = init
+        self.upper = upper
+        self.t2star = t2star
+        self.canonical = canonical
+
+    @property
+    def n_params(self):
+        return len(self.param_names)
+
+
+def _inv(r2):
+    return np.divide(1.0, r2, out=np.zeros_like(r2), where=r2 > 0)
+
+
+def _decay(p, te, k=1):
+    return np.exp(-te[None, :] * p[:, k, None])
+
+
+def _mono_jac(p, te):
+    e = _decay(p, te)
+    return np.stack([e, -te[None, :] * p[:, 0, None] * e], axis=-1)
+
+
+def _offset_jac(p, te):
+    e = _decay(p, te)
+    return np.stack([e, -te[None, :] * p[:, 0, None] * e, np.ones_like(e)], axis=-1)
+
+
+def _biexp_predict(p, te):
+    return p[:, 0, None] * _decay(p, te, 1) + p[:, 2, None] * _decay(p, te, 3)
+
+
+def _biexp_jac(p, te):
+    e1, e2 = _decay(p, te, 1), _decay(p, te, 3)
+    return np.stack([e1, -te[None, :] * p[:, 0, None] * e1,
+                     e2, -te[None, :] * p[:, 2, None] * e2], axis=-1)
+
+
+def _biexp_canonical(p):
+    """Order the components so that the first one is the fast (larger R2*)."""
+    swap = p[:, 1] < p[:, 3]
+    p[swap] = p[swap][:, [2, 3, 0, 1]]
+    return p
+
+
+def _biexp_t2star(p):
+    """Amplitude-weighted mean relaxation rate, reported as T2*."""
+    amp = p[:, 0] + p[:, 2]
+    r2 = np.divide(p[:, 0] * p[:, 1] + p[:, 2] * p[:, 3], amp,
+                   out=np.zeros_like(amp), where=amp > 0)
+    return _inv(r2)
+
+
+def _rician_predict(p, te):
+    s = p[:, 0, None] * _decay(p, te)
+    return np.sqrt(s * s + 2.0 * p[:, 2, None] ** 2)
+
+
+def _rician_jac(p, te):
+    e = _decay(p, te)
+    m = np.maximum(_rician_predict(p, te), 1e-300)
+    s0, sigma = p[:, 0, None], p[:, 2, None]
+    return np.stack([s0 * e * e / m,
+                     -te[None, :] * s0 * s0 * e * e / m,
+                     2.0 * sigma / m * np.ones_like(e)], axis=-1)
+
+
+def _floor(y):
+    return 0.1 * np.maximum(y.min(axis=1), 0.0)
+
+
+MODELS = {
+    'mono': RelaxationModel(
+        'mono', ('s0', 'r2star'),
+        predict=lambda p, te: p[:, 0, None] * _decay(p, te),
+        jacobian=_mono_jac,
+        init=lambda y, te, s0, r2: np.stack([s0, r2], axis=1),
+        upper=lambda r2max: np.array([np.inf, r2max]),
+        t2star=lambda p: _inv(p[:, 1])),
+    'mono_offset': RelaxationModel(
+        'mono_offset', ('s0', 'r2star', 'offset'),
+        predict=lambda p, te: p[:, 0, None] * _decay(p, te) + p[:, 2, None],
+        jacobian=_offset_jac,
+        init=lambda y, te, s0, r2: np.stack([s0, r2, _floor(y)], axis=1),
+        upper=lambda r2max: np.array([np.inf, r2max, np.inf]),
+        t2star=lambda p: _inv(p[:, 1])),
+    'biexp': RelaxationModel(
+        'biexp', ('a_fast', 'r2star_fast', 'a_slow', 'r2star_slow'),
+        predict=_biexp_predict,
+        jacobian=_biexp_jac,
+        init=lambda y, te, s0, r2: np.stack([0.5 * s0, 2.0 * r2, 0.5 * s0, 0.5 * r2], axis=1),
+        upper=lambda r2max: np.array([np.inf, r2max, np.inf, r2max]),
+        t2star=_biexp_t2star,
+        canonical=_biexp_canonical),
+    'rician_mono': RelaxationModel(
+        'rician_mono', ('s0', 'r2star', 'sigma'),
+        predict=_rician_predict,
+        jacobian=_rician_jac,
+        init=lambda y, te, s0, r2: np.stack([s0, r2, _floor(y)], axis=1),
+        upper=lambda r2max: np.array([np.inf, r2max, np.inf]),
+        t2star=lambda p: _inv(p[:, 1])),
+}
+
+
+def fit_model(model, signal, te_values, p0, r2star_max=np.inf, max_iter=500, tol=1e-10,
+              lam_init=1e-3, lam_max=1e10):
+    """
+    Batched projected Levenberg-Marquardt for any registered model.
+
+    Same scheme as fit_mono_exponential (per-voxel damping, projection
+    onto the bounds, accept only cost decreases), with the per-voxel
+    P x P normal equations solved by one batched np.linalg.solve. A tiny
+    ridge keeps every system positive definite.
+
+    Parameters
+    ----------
+    model : RelaxationModel or str
+    signal : np.ndarray, shape (n_voxels, n_echoes)
+    te_values : np.ndarray, shape (n_echoes,)
+    p0 : np.ndarray, shape (n_voxels, n_params)
+
+    Returns
+    -------
+    params : np.ndarray, shape (n_voxels, n_params)
+    rss : np.ndarray, shape (n_voxels,)
+    n_iter : int
+    """
+    if isinstance(model, str):
+        model = MODELS[model]
+    y = np.asarray(signal, dtype=np.float64)
+    te = np.asarray(te_values, dtype=np.float64)
+    upper = model.upper(r2star_max)
+    p = np.clip(np.asarray(p0, dtype=np.float64), 0.0, upper)
+
+    def cost_of(pp, yy):
+        r = yy - model.predict(pp, te)
+        return np.einsum('ij,ij->i', r, r)
+
+    n = y.shape[0]
+    lam = np.full(n, lam_init)
+    cost = cost_of(p, y)
+    active = np.arange(n)
+    eye = np.eye(model.n_params)
+
+    it = 0
+    for it in range(1, max_iter + 1):
+        if active.size == 0:
+            break
+        ya, pa, la = y[active], p[active], lam[active]
+        J = model.jacobian(pa, te)
+        res = ya - model.predict(pa, te)
+        H = np.einsum('nep,neq->npq', J, J)
+        g = np.einsum('nep,ne->np', J, res)
+        d = np.einsum('npp->np', H)
+        ridge = 1e-12 * d.sum(axis=1, keepdims=True) + 1e-30
+        A = H + eye * (la[:, None] * d + ridge)[:, :, None]
+        step = np.linalg.solve(A, g[:, :, None])[:, :, 0]
+
+        # Parameters the step pushes out of the box are held on the bound
+        # and the free ones re-solved given that move (the n-parameter
+        # version of the face re-solve in fit_mono_exponential).
+        p_new = np.clip(pa + step, 0.0, upper)
+        bound = p_new != pa + step
+        clipped = bound.any(axis=1)
+        if clipped.any():
+            Ac, bc = A[clipped], bound[clipped]
+            db = np.where(bc, p_new[clipped] - pa[clipped], 0.0)
+            rhs = g[clipped] - np.einsum('npq,nq->np', Ac, db)
+            keep = ~bc[:, :, None] & ~bc[:, None, :]
+            Ac = np.where(keep, Ac, 0.0) + eye * bc[:, :, None]
+            rhs = np.where(bc, db, rhs)
+            step_c = np.linalg.solve(Ac, rhs[:, :, None])[:, :, 0]
+            p_new[clipped] = np.clip(pa[clipped] + step_c, 0.0, upper)
+        cost_old = cost[active]
+        cost_new = cost_of(p_new, ya)
+
+        accept = cost_new < cost_old
+        idx = active[accept]
+        p[idx] = p_new[accept]
+        cost[idx] = cost_new[accept]
+        lam[active] = np.where(accept, la * 0.1, la * 10.0)
+
+        rel = (cost_old - cost_new) / np.maximum(cost_old, 1e-300)
+        done = (accept & (rel < tol)) | (lam[active] > lam_max) | (cost[active] == 0)
+        active = active[~done]
+
+    if model.canonical is not None:
+        p = model.canonical(p)
+    return p, cost, it
+
+
+def information_criteria(rss, n_echoes, n_params):
+    """
+    Gaussian least-squares AIC and BIC per voxel.
+
+    AIC = n ln(RSS/n) + 2k, BIC = n ln(RSS/n) + k ln(n). Models with
+    k >= n fit the echoes exactly and cannot be compared; they get +inf.
+    """
+    if n_params >= n_echoes:
+        inf = np.full(len(rss), np.inf)
+        return inf, inf.copy()
+    ll = n_echoes * np.log(np.maximum(rss, 1e-300) / n_echoes)
+    return ll + 2 * n_params, ll + n_params * np.log(n_echoes)
+
+
+def fit_models_chunked(echoes, te_values, mask_fn, models=('mono', 'mono_offset', 'rician_mono'),
+                       t2star_min=1.0, chunk_voxels=DEFAULT_CHUNK_VOXELS):
+    """
+    Fit several registered models to every masked voxel and select the
+    best per voxel by AIC and by BIC, slab by slab.
+
+    Every model starts from the log-linear estimate (voxels with a
+    non-positive echo or no decay are skipped).
+
+    Returns
+    -------
+    maps : dict of np.ndarray (echo shape)
+        '<model>_<param>' parameter maps, 't2star_<model>', 'aic_<model>'
+        and 'bic_<model>' (float32), plus 'best_aic' / 'best_bic' (uint8,
+        1-based index into ``models``, 0 = not fitted).
+    """
+    te = np.asarray(te_values, dtype=np.float64)
+    models = [MODELS[m] for m in models]
+    shape = echoes.shape
+    maps = {'best_aic': np.zeros(shape, np.uint8), 'best_bic': np.zeros(shape, np.uint8)}
+    for model in models:
+        for key in ([f'{model.name}_{p}' for p in model.param_names]
+                    + [f't2star_{model.name}', f'aic_{model.name}', f'bic_{model.name}']):
+            maps[key] = np.zeros(shape, np.float32)
+
+    for z0, z1 in iter_slabs(shape, chunk_voxels):
+        slab = echoes.slab(z0, z1)
+        m = mask_fn(slab)
+        y = slab[m].astype(np.float64)
+        s0, r2 = loglinear_mono(np.maximum(y, 1e-10), te)
+        ok = np.all(y > 0, axis=1) & (r2 > 0)
+        sel = np.zeros(m.shape, bool)
+        sel[m] = ok
+        y, s0, r2 = y[ok], s0[ok], r2[ok]
+        if not len(y):
+            continue
+
+        aic = np.empty((len(models), len(y)))
+        bic = np.empty((len(models), len(y)))
+        for k, model in enumerate(models):
+            p0 = model.init(y, te, s0, r2)
+            params, rss, _ = fit_model(model, y, te, p0, r2star_max=1.0 / t2star_min)
+            aic[k], bic[k] = information_criteria(rss, len(te), model.n_params)
+            for j, name in enumerate(model.param_names):
+                maps[f'{model.name}_{name}'][:, :, z0:z1][sel] = params[:, j]
+            maps[f't2star_{model.name}'][:, :, z0:z1][sel] = model.t2star(params)
+            maps[f'aic_{model.name}'][:, :, z0:z1][sel] = aic[k]
+            maps[f'bic_{model.name}'][:, :, z0:z1][sel] = bic[k]
+        maps['best_aic'][:, :, z0:z1][sel] = np.argmin(aic, axis=0) + 1
+        maps['best_bic'][:, :, z0:z1][sel] = np.argmin(bic, axis=0) + 1
+    return maps
+
+
+# ============================================================
+# UNCERTAINTY
+# ============================================================
+
+# Voxel x replicate rows refitted per batched LM call in the bootstrap
+DEFAULT_BOOTSTRAP_ROWS = 1 << 18
+
+
+def mono_standard_errors(signal, te_values, s0, r2star):
+    """
+    Asymptotic standard errors of S0 and R2* from the Jacobian.
+
+    Cov = sigma^2 (J^T J)^-1 with sigma^2 = RSS / (n_echoes - 2), using the
+    closed-form inverse of each voxel's 2x2 matrix.
+
+    Returns
+    -------
+    se_s0, se_r2star : np.ndarray, shape (n_voxels,)
+        NaN where J^T J is singular or there are no residual degrees of
+        freedom.
+    """
+    y = np.asarray(signal, dtype=np.float64)
+    te = np.asarray(te_values, dtype=np.float64)
+    dof = y.shape[1] - 2
+    e = np.exp(-te[None, :] * r2star[:, None])
+    j1 = -te[None, :] * s0[:, None] * e
+    a = np.einsum('ij,ij->i', e, e)
+    b = np.einsum('ij,ij->i', e, j1)
+    c = np.einsum('ij,ij->i', j1, j1)
+    det = a * c - b * b
+    rss = _mono_cost(y, te, s0, r2star)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sigma2 = rss / dof if dof > 0 else np.full(len(y), np.nan)
+        ok = det > 0
+        se_s0 = np.where(ok, np.sqrt(sigma2 * c / det), np.nan)
+        se_r2 = np.where(ok, np.sqrt(sigma2 * a / det), np.nan)
+    return se_s0, se_r2
+
+
+def bootstrap_mono(signal, te_values, s0, r2star, n_boot=200, r2star_max=np.inf,
+                   ci=0.95, rng=None, max_rows=DEFAULT_BOOTSTRAP_ROWS):
+    """
+    Residual bootstrap of the mono-exponential fit, vectorised over voxels
+    and replicates.
+
+    For each voxel the residuals (scaled by sqrt(n / (n - 2))) are
+    resampled with replacement onto the fitted curve and every replicate
+    is refitted with fit_mono_exponential, warm-started at the fit.
+    Voxels are processed in blocks of at most ``max_rows`` voxel x
+    replicate rows.
+
+    With only a handful of echoes the resampled residuals understate the
+    noise, so the intervals are narrower than nominal; the analytic
+    standard errors are the better default for 4-echo data.
+
+    Returns
+    -------
+    se_s0, se_t2star, t2star_lo, t2star_hi : np.ndarray, shape (n_voxels,)
+        Bootstrap standard errors and percentile interval (level ``ci``).
+        Replicates with R2* = 0 (infinite T2*) are left out of se_t2star
+        and make t2star_hi infinite.
+    """
+    y = np.asarray(signal, dtype=np.float64)
+    te = np.asarray(te_values, dtype=np.float64)
+    rng = np.random.default_rng(rng)
+    n, n_te = y.shape
+    fitted = s0[:, None] * np.exp(-te[None, :] * r2star[:, None])
+    res = (y - fitted) * np.sqrt(n_te / max(n_te - 2, 1))
+    q = [50 * (1 - ci), 50 * (1 + ci)]
+
+    out = np.full((4, n), np.nan)
+    step = max(1, max_rows // n_boot)
+    for v0 in range(0, n, step):
+        v1 = min(v0 + step, n)
+        nv = v1 - v0
+        pick = rng.integers(0, n_te, size=(nv, n_boot, n_te))
+        y_boot = fitted[v0:v1, None, :] + np.take_along_axis(
+            res[v0:v1, None, :].repeat(n_boot, axis=1), pick, axis=2)
+        s0_b, r2_b, _ = fit_mono_exponential(
+            y_boot.reshape(-1, n_te), te,
+            np.repeat(s0[v0:v1], n_boot), np.repeat(r2star[v0:v1], n_boot),
+            r2star_max=r2star_max)
+        s0_b = s0_b.reshape(nv, n_boot)
+        r2_b = r2_b.reshape(nv, n_boot)
+        out[0, v0:v1] = s0_b.std(axis=1, ddof=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t2_b = np.where(r2_b > 0, 1.0 / r2_b, np.nan)
+            out[1, v0:v1] = np.nanstd(t2_b, axis=1, ddof=1)
+            # Percentiles of R2* map to T2* percentiles in reverse order
+            r2_hi, r2_lo = np.percentile(r2_b, q[::-1], axis=1)
+            out[2, v0:v1] = 1.0 / r2_hi
+            out[3, v0:v1] = np.where(r2_lo > 0, 1.0 / r2_lo, np.inf)
+    return out[0], out[1], out[2], out[3]
+
+
+UNCERTAINTY_MAPS = ('t2star_se', 's0_se', 't2star_ci_low', 't2star_ci_high')
+
+
+def t2star_uncertainty_chunked(echoes, te_values, t2star_map, s0_map, method='analytic',
+                               t2star_min=1.0, t2star_max=500.0, ci=0.95, n_boot=200,
+                               seed=0, chunk_voxels=DEFAULT_CHUNK_VOXELS):
+    """
+    Per-voxel T2*/S0 uncertainty for already fitted maps, slab by slab.
+
+    Voxels with a T2* inside (t2star_min, t2star_max) and S0 > 0 get an
+    estimate; all others are 0. Call this before hole filling, so filled
+    voxels do not get an uncertainty.
+
+    method='analytic' uses Jacobian standard errors. The T2* interval is
+    the inverted Student-t interval of R2* (n_echoes - 2 degrees of
+    freedom), capped at t2star_max, so it is asymmetric and stays
+    positive. method='bootstrap' uses bootstrap_mono with ``n_boot``
+    replicates.
+
+    Returns
+    -------
+    maps : dict of np.ndarray (float32, echo shape)
+        Keys UNCERTAINTY_MAPS: 't2star_se', 's0_se', 't2star_ci_low',
+        't2star_ci_high'.
+    """
+    if method not in ('analytic', 'bootstrap'):
+        raise ValueError(f"Unknown uncertainty method: {method}")
+    te = np.asarray(te_values, dtype=np.float64)
+    maps = {name: np.zeros(echoes.shape, dtype=np.float32) for name in UNCERTAINTY_MAPS}
+    rng = np.random.default_rng(seed)
+    tq = student_t.ppf(0.5 * (1 + ci), max(len(te) - 2, 1))
+
+    for z0, z1 in iter_slabs(echoes.shape, chunk_voxels):
+        t2 = t2star_map[:, :, z0:z1]
+        s0 = s0_map[:, :, z0:z1]
+        m = (t2 > t2star_min) & (t2 < t2star_max) & (s0 > 0)
+        if not m.any():
+            continue
+        y = echoes.slab(z0, z1)[m].astype(np.float64)
+        s0_v = s0[m].astype(np.float64)
+        r2_v = 1.0 / t2[m].astype(np.float64)
+
+        if method == 'analytic':
+            se_s0, se_r2 = mono_standard_errors(y, te, s0_v, r2_v)
+            se_t2 = se_r2 / r2_v ** 2
+            with np.errstate(divide='ignore'):
+                lo = 1.0 / (r2_v + tq * se_r2)
+                hi_r2 = r2_v - tq * se_r2
+                hi = np.where(hi_r2 > 0, 1.0 / np.maximum(hi_r2, 1e-300), t2star_max)
+            hi = np.minimum(hi, t2star_max)
+        else:
+            se_s0, se_t2, lo, hi = bootstrap_mono(
+                y, te, s0_v, r2_v, n_boot=n_boot, r2star_max=1.0 / t2star_min,
+                ci=ci, rng=rng)
+            hi = np.minimum(hi, t2star_max)
+
+        for name, vals in zip(UNCERTAINTY_MAPS, (se_t2, se_s0, lo, hi)):
+            maps[name][:, :, z0:z1][m] = np.nan_to_num(vals, nan=0.0)
+    return maps
+
+
+# ============================================================
+# HOLE FILLING
+# ============================================================
+
+_NEIGHBOUR_OFFSETS = np.stack(np.meshgrid([-1, 0, 1], [-1, 0, 1], [-1, 0, 1],
+                                          indexing='ij'), axis=-1).reshape(-1, 3)
+
+
+def fill_holes_median(maps, mask, max_iter=10):
+    """
+    Fill zero voxels inside ``mask`` with the 3x3x3 median, in place.
+
+    Equivalent to repeatedly applying scipy.ndimage.median_filter(size=3)
+    and copying the filtered values into the holes, but only the hole
+    voxels and their 26 neighbours are touched, so the cost scales with
+    the number of holes instead of the volume size. All maps are filled
+    in the same pass; each map's holes are its own zero voxels. Each pass
+    uses the values from the previous pass (Jacobi update), as the
+    full-volume filter does, and a map stops once a pass fills nothing.
+
+    Parameters
+    ----------
+    maps : sequence of np.ndarray, each shape (nx, ny, nz)
+        Maps to fill in place (e.g. T2* and S0).
+    mask : np.ndarray of bool, shape (nx, ny, nz)
+    max_iter : int
+        Maximum number of passes.
+
+    Returns
+    -------
+    n_holes : list of int
+        Initial number of holes per map.
+    n_remaining : list of int
+        Holes left per map after filling.
+    """
+    shape = np.array(mask.shape)
+    flat = [m.reshape(-1) for m in maps]
+    holes = [np.flatnonzero(mask.reshape(-1) & (f == 0)) for f in flat]
+    n_holes = [len(h) for h in holes]
+
+    for _ in range(max_iter):
+        active = [k for k, h in enumerate(holes) if len(h)]
+        if not active:
+            break
+        # Neighbourhoods of the union of holes; edge coordinates are clipped,
+        # which matches median_filter's default 'reflect' mode for size 3
+        idx = np.unique(np.concatenate([holes[k] for k in active]))
+        coords = np.stack(np.unravel_index(idx, mask.shape), axis=-1)
+        nb = np.clip(coords[:, None, :] + _NEIGHBOUR_OFFSETS[None], 0, shape - 1)
+        nb = np.ravel_multi_index(tuple(nb.transpose(2, 0, 1)), mask.shape)
+
+        updates = []
+        for k in active:
+            vals = flat[k][nb]
+            med = np.partition(vals, 13, axis=1)[:, 13]
+            pos = np.searchsorted(idx, holes[k])
+            updates.append((k, med[pos]))
+        filled_any = False
+        for k, new in updates:
+            flat[k][holes[k]] = new
+            still = new == 0
+            if still.sum() == len(holes[k]):
+                holes[k] = holes[k][:0]
+            else:
+                filled_any = True
+                holes[k] = holes[k][still]
+        if not filled_any:
+            break
+
+    for m, f in zip(maps, flat):
+        if not np.shares_memory(m, f):
+            m[...] = f.reshape(m.shape)
+    n_remaining = [int((mask.reshape(-1) & (f == 0)).sum()) for f in flat]
+    return n_holes, n_remaining
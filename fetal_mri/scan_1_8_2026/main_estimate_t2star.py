@@ -16,10 +16,16 @@ Usage:
 """
 
 import os
-import subprocess
+import sys
 import numpy as np
 import nibabel as nib
-from scipy.optimize import curve_fit
+
+# Shared registration/fitting code lives in the parent fetal_mri/ directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from coregistration import coregister_with_flirt  # noqa: E402
+from relaxometry import (  # noqa: E402
+    EchoSeries, fit_t2star_chunked, max_mean_signal, t2star_uncertainty_chunked,
+)
 
 # ============================================================
 # USER SETTINGS
@@ -46,6 +52,16 @@ t2star_output = os.path.join(output_dir, 'T2star_map.nii.gz')
 s0_output = os.path.join(output_dir, 'S0_map.nii.gz')
 r2star_output = os.path.join(output_dir, 'R2star_map.nii.gz')
 
+# Optional per-voxel uncertainty: None, 'analytic' (Jacobian standard errors)
+# or 'bootstrap' (residual bootstrap); written next to the maps above
+UNCERTAINTY = None
+uncertainty_outputs = {
+    't2star_se': os.path.join(output_dir, 'T2star_SE_map.nii.gz'),
+    's0_se': os.path.join(output_dir, 'S0_SE_map.nii.gz'),
+    't2star_ci_low': os.path.join(output_dir, 'T2star_CI_low.nii.gz'),
+    't2star_ci_high': os.path.join(output_dir, 'T2star_CI_high.nii.gz'),
+}
+
 # Signal threshold: voxels below this fraction of the max signal are masked out
 signal_threshold_fraction = 0.05
 
@@ -53,197 +69,6 @@ signal_threshold_fraction = 0.05
 T2STAR_MIN = 1.0    # ms
 T2STAR_MAX = 500.0  # ms
 
-# ============================================================
-# FUNCTIONS
-# ============================================================
-
-
-def coregister_with_flirt(input_files, reference_idx, output_dir):
-    """
-    Coregister all images to a common reference using FSL flirt.
-
-    Parameters
-    ----------
-    input_files : list of str
-        Paths to input NIfTI files.
-    reference_idx : int
-        Index of the reference image (not registered, just copied).
-    output_dir : str
-        Directory for coregistered outputs and transform matrices.
-
-    Returns
-    -------
-    coreg_files : list of str
-        Paths to the coregistered NIfTI files (in reference space).
-    """
-    coreg_dir = os.path.join(output_dir, 'coregistered')
-    os.makedirs(coreg_dir, exist_ok=True)
-
-    ref_file = input_files[reference_idx]
-    coreg_files = []
-
-    for i, inp in enumerate(input_files):
-        basename = os.path.basename(inp).replace('.nii.gz', '')
-        out_file = os.path.join(coreg_dir, f'{basename}_coreg.nii.gz')
-        omat_file = os.path.join(coreg_dir, f'{basename}_coreg.mat')
-
-        if i == reference_idx:
-            # Reference image — just copy it
-            print(f"  [TE idx {i}] Reference image — copying: {os.path.basename(inp)}")
-            cmd = ['cp', inp, out_file]
-            subprocess.run(cmd, check=True)
-        else:
-            print(f"  [TE idx {i}] Registering {os.path.basename(inp)} -> reference ...")
-            cmd = [
-                'flirt',
-                '-in', inp,
-                '-ref', ref_file,
-                '-out', out_file,
-                '-omat', omat_file,
-                '-dof', '6',                  # rigid body
-                '-cost', 'corratio',           # correlation ratio
-                '-searchrx', '-30', '30',
-                '-searchry', '-30', '30',
-                '-searchrz', '-30', '30',
-                '-interp', 'sinc',
-            ]
-            print(f"    CMD: {' '.join(cmd)}")
-            result = subprocess.run(cmd, capture_output=True, text=True)
-            if result.returncode != 0:
-                print(f"    FLIRT STDERR: {result.stderr}")
-                raise RuntimeError(f"flirt failed for {inp}")
-            print(f"    Done -> {os.path.basename(out_file)}")
-
-        coreg_files.append(out_file)
-
-    return coreg_files
-
-def mono_exponential(te, s0, r2star):
-    """Mono-exponential decay: S = S0 * exp(-TE * R2*)."""
-    return s0 * np.exp(-te * r2star)
-
-
-def estimate_t2star_loglinear(images, te_values):
-    """
-    Estimate T2* using a log-linear (weighted least squares) fit.
-
-    ln(S) = ln(S0) - TE / T2*
-
-    Parameters
-    ----------
-    images : np.ndarray, shape (nx, ny, nz, n_echoes)
-        Multi-echo image data.
-    te_values : np.ndarray, shape (n_echoes,)
-        Echo times in milliseconds.
-
-    Returns
-    -------
-    t2star_map : np.ndarray, shape (nx, ny, nz)
-    s0_map : np.ndarray, shape (nx, ny, nz)
-    """
-    n_echoes = len(te_values)
-    shape = images.shape[:3]
-
-    # Flatten spatial dims for vectorised fitting
-    voxels = images.reshape(-1, n_echoes).astype(np.float64)
-
-    # Build mask: all echoes must be positive
-    mask = np.all(voxels > 0, axis=1)
-
-    # Log-transform
-    log_signal = np.zeros_like(voxels)
-    log_signal[mask] = np.log(voxels[mask])
-
-    # Design matrix for linear regression: ln(S) = a + b*TE
-    # where a = ln(S0), b = -1/T2*
-    A = np.column_stack([np.ones(n_echoes), te_values])
-
-    # Solve least squares for all masked voxels at once
-    # log_signal[mask] has shape (n_masked_voxels, n_echoes)
-    # We need to solve A @ [a, b]^T = log_signal^T for each voxel
-    # Using pseudoinverse: params = (A^T A)^-1 A^T y
-    ATA_inv_AT = np.linalg.pinv(A)  # shape (2, n_echoes)
-
-    params = np.zeros((voxels.shape[0], 2))
-    params[mask] = (ATA_inv_AT @ log_signal[mask].T).T
-
-    # Extract maps
-    s0_flat = np.exp(params[:, 0])
-    slope = params[:, 1]  # = -1/T2*
-
-    # T2* = -1 / slope (slope should be negative for decay)
-    t2star_flat = np.zeros(voxels.shape[0])
-    valid_slope = mask & (slope < 0)
-    t2star_flat[valid_slope] = -1.0 / slope[valid_slope]
-
-    # Reshape
-    t2star_map = t2star_flat.reshape(shape)
-    s0_map = s0_flat.reshape(shape)
-
-    return t2star_map, s0_map
-
-
-def estimate_t2star_nlls(images, te_values, t2star_init, s0_init):
-    """
-    Refine T2* estimates using non-linear least squares (Levenberg-Marquardt).
-
-    Uses the log-linear estimates as initial guesses. Only fits voxels
-    where the initial estimate is within a valid range.
-
-    Parameters
-    ----------
-    images : np.ndarray, shape (nx, ny, nz, n_echoes)
-    te_values : np.ndarray, shape (n_echoes,)
-    t2star_init : np.ndarray, shape (nx, ny, nz)
-    s0_init : np.ndarray, shape (nx, ny, nz)
-
-    Returns
-    -------
-    t2star_map : np.ndarray, shape (nx, ny, nz)
-    s0_map : np.ndarray, shape (nx, ny, nz)
-    """
-    shape = images.shape[:3]
-    n_echoes = len(te_values)
-
-    voxels = images.reshape(-1, n_echoes).astype(np.float64)
-    t2_init_flat = t2star_init.ravel()
-    s0_init_flat = s0_init.ravel()
-
-    t2star_flat = t2_init_flat.copy()
-    s0_flat = s0_init_flat.copy()
-
-    # Only refine voxels with valid initial estimates
-    mask = (t2_init_flat > T2STAR_MIN) & (t2_init_flat < T2STAR_MAX) & (s0_init_flat > 0)
-    indices = np.where(mask)[0]
-
-    print(f"  Refining {len(indices)} voxels with NLLS...")
-
-    for count, idx in enumerate(indices):
-        if count % 50000 == 0 and count > 0:
-            print(f"    {count}/{len(indices)} voxels fitted...")
-
-        y = voxels[idx]
-        s0_guess = s0_init_flat[idx]
-        r2star_guess = 1.0 / t2_init_flat[idx]
-
-        try:
-            popt, _ = curve_fit(
-                mono_exponential,
-                te_values,
-                y,
-                p0=[s0_guess, r2star_guess],
-                bounds=([0, 0], [np.inf, 1.0 / T2STAR_MIN]),
-                maxfev=500,
-            )
-            s0_flat[idx] = popt[0]
-            t2star_flat[idx] = 1.0 / popt[1] if popt[1] > 0 else 0.0
-        except (RuntimeError, ValueError):
-            # Keep the log-linear estimate
-            pass
-
-    return t2star_flat.reshape(shape), s0_flat.reshape(shape)
-
-
 # ============================================================
 # MAIN
 # ============================================================
@@ -261,40 +86,26 @@ def main():
     print(f"  Reference: TE={TE_values[reference_idx]:.0f} ms — {os.path.basename(input_files[reference_idx])}")
     coreg_files = coregister_with_flirt(input_files, reference_idx, output_dir)
 
-    # --- Load coregistered images ---
-    print("\nLoading coregistered images...")
-    imgs = []
-    ref_img = None
+    # --- Open coregistered images (read lazily, slab by slab) ---
+    print("\nOpening coregistered images...")
     for i, fpath in enumerate(coreg_files):
         print(f"  TE={TE_values[i]:.1f} ms : {fpath}")
-        nii = nib.load(fpath)
-        if ref_img is None:
-            ref_img = nii
-        imgs.append(nii.get_fdata().astype(np.float64))
-
-    # Stack into 4D: (nx, ny, nz, n_echoes)
-    images = np.stack(imgs, axis=-1)
-    print(f"  Image shape: {images.shape}")
+    echoes = EchoSeries(coreg_files)
+    print(f"  Image shape: {echoes.shape + (echoes.n_echoes,)}")
 
-    # --- Create brain mask ---
+    # --- Signal threshold for the brain mask ---
     print("\nCreating signal mask...")
-    mean_img = images.mean(axis=-1)
-    signal_threshold = signal_threshold_fraction * mean_img.max()
-    brain_mask = mean_img > signal_threshold
-    n_voxels = brain_mask.sum()
+    signal_threshold = signal_threshold_fraction * max_mean_signal(echoes)
     print(f"  Threshold: {signal_threshold:.1f}")
-    print(f"  Masked voxels: {n_voxels}")
 
-    # Zero out background
-    images[~brain_mask] = 0
-
-    # --- Log-linear T2* estimation ---
-    print("\nStep 1: Log-linear T2* estimation...")
-    t2star_map, s0_map = estimate_t2star_loglinear(images, TE_values)
-
-    # --- NLLS refinement ---
-    print("\nStep 2: Non-linear least squares refinement...")
-    t2star_map, s0_map = estimate_t2star_nlls(images, TE_values, t2star_map, s0_map)
+    # --- Log-linear T2* estimation + NLLS refinement, slab by slab ---
+    print("\nFitting T2* (log-linear initialisation + NLLS refinement)...")
+    t2star_map, s0_map, brain_mask = fit_t2star_chunked(
+        echoes, TE_values,
+        mask_fn=lambda slab: slab.mean(axis=-1) > signal_threshold,
+        t2star_min=T2STAR_MIN, t2star_max=T2STAR_MAX,
+    )
+    print(f"  Masked voxels: {brain_mask.sum()}")
 
     # --- Clip and clean ---
     print("\nCleaning T2* map...")
@@ -302,6 +113,15 @@ def main():
     t2star_map[(t2star_map < T2STAR_MIN) | (t2star_map > T2STAR_MAX)] = 0
     s0_map[~brain_mask] = 0
 
+    # --- Optional per-voxel uncertainty (before any hole filling) ---
+    uncertainty_maps = {}
+    if UNCERTAINTY:
+        print(f"\nEstimating T2* uncertainty ({UNCERTAINTY})...")
+        uncertainty_maps = t2star_uncertainty_chunked(
+            echoes, TE_values, t2star_map, s0_map, method=UNCERTAINTY,
+            t2star_min=T2STAR_MIN, t2star_max=T2STAR_MAX,
+        )
+
     # R2* = 1000 / T2* (in s^-1, with T2* in ms)
     r2star_map = np.zeros_like(t2star_map)
     valid = t2star_map > 0
@@ -320,21 +140,25 @@ def main():
     print(f"\nSaving outputs to: {output_dir}")
     os.makedirs(output_dir, exist_ok=True)
 
-    affine = ref_img.affine
-    header = ref_img.header
+    affine = echoes.affine
+    header = echoes.header
 
-    t2star_nii = nib.Nifti1Image(t2star_map.astype(np.float32), affine, header)
+    t2star_nii = nib.Nifti1Image(t2star_map, affine, header)
     nib.save(t2star_nii, t2star_output)
     print(f"  T2* map  : {t2star_output}")
 
-    s0_nii = nib.Nifti1Image(s0_map.astype(np.float32), affine, header)
+    s0_nii = nib.Nifti1Image(s0_map, affine, header)
     nib.save(s0_nii, s0_output)
     print(f"  S0 map   : {s0_output}")
 
-    r2star_nii = nib.Nifti1Image(r2star_map.astype(np.float32), affine, header)
+    r2star_nii = nib.Nifti1Image(r2star_map, affine, header)
     nib.save(r2star_nii, r2star_output)
     print(f"  R2* map  : {r2star_output}")
 
+    for name, data in uncertainty_maps.items():
+        nib.save(nib.Nifti1Image(data, affine, header), uncertainty_outputs[name])
+        print(f"  {name:<15}: {uncertainty_outputs[name]}")
+
     print("\nDone.")
 
 
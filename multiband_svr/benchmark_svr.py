@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+"""
+benchmark_svr.py
+
+Synthetic-phantom benchmark for simplesvr.py: no patient data needed.
+
+A 3D ellipsoid phantom (1 mm, world origin at its centre) is sampled into thick-slice stacks at
+several orientations, each slice with a Gaussian slice profile, its own random rigid motion and
+Gaussian noise; optionally a fraction of the slices is corrupted by a signal-dropout band. svr_pipeline is then run on the stacks and the report gives
+ - wall time per pipeline stage and in total, peak RSS
+ - slices kept / dropped
+ - motion error of the kept slices against the simulated motion (rotation in deg, translation in mm)
+ - PSNR / SSIM of the reconstruction against the phantom, on the reconstruction grid.
+
+Usage:
+    python benchmark_svr.py --preset small
+    python benchmark_svr.py --preset medium --recon sr --pyramid 2 1 --json medium.json
+"""
+import argparse, json, os, resource, tempfile, time
+import numpy as np
+import nibabel as nib
+from scipy.ndimage import map_coordinates
+import torch
+from monai.losses import SSIMLoss
+
+from simplesvr import rigid_to_matrix, svr_pipeline
+
+# phantom size (voxels, 1 mm), number of stacks, slice thickness / in-plane spacing (mm),
+# motion sd (deg, mm), noise sd (fraction of max intensity), fraction of corrupted slices and the pipeline settings
+PRESETS = {
+    'small':  dict(size=48, n_stacks=3, thickness=3.0, inplane=1.0, rot_sd=2.0, trans_sd=1.0, noise=0.02, outliers=0.0,
+                   out_spacing=1.0, n_outer=2, slice_steps=60, levels=(2, 1)),
+    'medium': dict(size=72, n_stacks=4, thickness=3.0, inplane=1.0, rot_sd=3.0, trans_sd=1.5, noise=0.02, outliers=0.0,
+                   out_spacing=1.0, n_outer=3, slice_steps=80, levels=(2, 1)),
+    'large':  dict(size=96, n_stacks=6, thickness=2.5, inplane=1.0, rot_sd=3.0, trans_sd=2.0, noise=0.03, outliers=0.0,
+                   out_spacing=1.0, n_outer=3, slice_steps=100, levels=(4, 2, 1)),
+}
+
+# (centre, semi-axes) as fractions of the half-size, rotation about z (deg), intensity
+ELLIPSOIDS = [
+    ((0.0, 0.0, 0.0), (0.69, 0.92, 0.81), 0, 100.0),
+    ((0.0, -0.0184, 0.0), (0.6624, 0.874, 0.78), 0, -60.0),
+    ((0.22, 0.0, -0.25), (0.11, 0.31, 0.22), -18, -20.0),
+    ((-0.22, 0.0, -0.25), (0.16, 0.41, 0.28), 18, -20.0),
+    ((0.0, 0.35, -0.25), (0.21, 0.25, 0.41), 0, 30.0),
+    ((0.0, 0.1, -0.25), (0.046, 0.046, 0.05), 0, 30.0),
+    ((-0.08, -0.605, -0.25), (0.046, 0.023, 0.05), 0, 30.0),
+    ((0.06, -0.605, -0.25), (0.046, 0.023, 0.02), 0, 30.0),
+    ((0.0, -0.1, 0.25), (0.046, 0.046, 0.1), 0, 25.0),
+]
+
+# -------------------------
+# Phantom + stack simulation
+# -------------------------
+def make_phantom(size):
+    """
+    3D Shepp-Logan-like phantom, (x,y,z) array, 1 mm voxels. Returns (data, affine); the affine puts
+    the world origin at the volume centre, which is also the centre of the simulated slice motion.
+    """
+    c = (size - 1) / 2.0
+    x, y, z = (np.indices((size, size, size), dtype=np.float32) - c) / c
+    data = np.zeros((size, size, size), dtype=np.float32)
+    for (cx, cy, cz), (a, b, cc), phi, val in ELLIPSOIDS:
+        t = np.deg2rad(phi)
+        xr = (x - cx) * np.cos(t) + (y - cy) * np.sin(t)
+        yr = -(x - cx) * np.sin(t) + (y - cy) * np.cos(t)
+        data[(xr / a) ** 2 + (yr / b) ** 2 + ((z - cz) / cc) ** 2 <= 1] += val
+    affine = np.eye(4)
+    affine[:3, 3] = -c
+    return data, affine
+
+def stack_orientations(n_stacks):
+    # axial, coronal, sagittal, then obliques: columns = (row dir, column dir, slice normal)
+    axes = [np.eye(3), np.eye(3)[:, [0, 2, 1]], np.eye(3)[:, [1, 2, 0]]]
+    orients = []
+    for i in range(n_stacks):
+        R = axes[i % 3]
+        if i >= 3:
+            tilt = np.deg2rad(20.0 + 10.0 * (i // 3))
+            R = rigid_to_matrix(np.array([tilt, tilt / 2, 0.0]), np.zeros(3))[:3, :3] @ R
+        orients.append(R)
+    return orients
+
+def simulate_stack(phantom, phantom_affine, orient, thickness, inplane, rot_sd, trans_sd, noise, rng, outliers=0.0, psf_samples=9):
+    """
+    Sample one thick-slice stack through phantom. Each slice gets a random rigid motion
+    (rotvec ~ N(0, rot_sd deg), translation ~ N(0, trans_sd mm)) about the world origin and a Gaussian
+    slice profile (FWHM = thickness). A fraction `outliers` of the slices gets a signal-dropout band
+    (a random third of the rows at 20% intensity), as from intra-slice motion. Returns (data (nx,ny,nz), affine, [(rot, trans)] per slice), where
+    (rot, trans) is the transform svr_pipeline should recover for the slice.
+    """
+    extent = phantom.shape[0] * np.abs(phantom_affine[0, 0])
+    nx = ny = int(np.ceil(extent / inplane))
+    nz = int(np.ceil(extent / thickness))
+    affine = np.eye(4)
+    affine[:3, 0] = orient[:, 0] * inplane
+    affine[:3, 1] = orient[:, 1] * inplane
+    affine[:3, 2] = orient[:, 2] * thickness
+    affine[:3, 3] = -affine[:3, :3] @ (np.array([nx, ny, nz]) - 1) / 2.0
+    sigma = thickness / (2 * np.sqrt(2 * np.log(2)))
+    offsets = np.linspace(-1.5 * sigma, 1.5 * sigma, psf_samples)
+    profile = np.exp(-0.5 * (offsets / sigma) ** 2)
+    profile /= profile.sum()
+    inv_phantom = np.linalg.inv(phantom_affine)
+    ii, jj = np.meshgrid(np.arange(nx), np.arange(ny), indexing='ij')
+    data = np.zeros((nx, ny, nz), dtype=np.float32)
+    motion = []
+    for k in range(nz):
+        rot = np.deg2rad(rng.normal(0.0, rot_sd, 3))
+        trans = rng.normal(0.0, trans_sd, 3)
+        T = rigid_to_matrix(rot, trans)
+        pix = np.stack([ii.ravel(), jj.ravel(), np.full(ii.size, k), np.ones(ii.size)])
+        world = T @ affine @ pix
+        normal = T[:3, :3] @ orient[:, 2]
+        vals = np.zeros(ii.size)
+        for o, w in zip(offsets, profile):
+            vox = inv_phantom @ (world + np.append(o * normal, 0.0)[:, None])
+            vals += w * map_coordinates(phantom, vox[:3], order=1, cval=0.0)
+        data[:, :, k] = vals.reshape(nx, ny)
+        motion.append((rot, trans))
+    for k in np.flatnonzero(rng.random(nz) < outliers):
+        j0 = rng.integers(0, ny - ny // 3 + 1)
+        data[:, j0:j0 + ny // 3, k] *= 0.2
+    data += rng.normal(0.0, noise * phantom.max(), data.shape).astype(np.float32)
+    return data, affine, motion
+
+# -------------------------
+# Metrics
+# -------------------------
+def motion_errors(transforms, truth):
+    # per kept slice: rotation angle of R_est^T R_true (deg) and translation difference (mm)
+    rot_err, trans_err = [], []
+    for est, true in zip(transforms, truth):
+        if est is None:
+            continue
+        Te, Tt = rigid_to_matrix(*est), rigid_to_matrix(*true)
+        cos = (np.trace(Te[:3, :3].T @ Tt[:3, :3]) - 1) / 2
+        rot_err.append(np.degrees(np.arccos(np.clip(cos, -1.0, 1.0))))
+        trans_err.append(np.linalg.norm(Te[:3, 3] - Tt[:3, 3]))
+    return np.array(rot_err), np.array(trans_err)
+
+def image_metrics(recon_path, phantom, phantom_affine):
+    # PSNR / SSIM of the reconstruction against the phantom resampled onto the reconstruction grid
+    img = nib.load(recon_path)
+    recon = img.get_fdata(dtype=np.float32)
+    ijk = np.indices(recon.shape).reshape(3, -1)
+    vox = np.linalg.inv(phantom_affine) @ img.affine @ np.vstack([ijk, np.ones(ijk.shape[1])])
+    ref = map_coordinates(phantom, vox[:3], order=1, cval=0.0).reshape(recon.shape).astype(np.float32)
+    data_range = float(phantom.max() - phantom.min())
+    mse = float(np.mean((recon - ref) ** 2))
+    psnr = 10 * np.log10(data_range ** 2 / mse) if mse > 0 else np.inf
+    win = min(7, min(recon.shape) // 2 * 2 - 1)
+    ssim = 1 - SSIMLoss(spatial_dims=3, data_range=data_range, win_size=win)(
+        torch.from_numpy(recon)[None, None], torch.from_numpy(ref)[None, None]).item()
+    return psnr, ssim
+
+def peak_rss_mb():
+    # ru_maxrss is in kB on Linux (bytes on macOS); children = registration worker processes
+    scale = 1.0 / 1024 if os.uname().sysname != 'Darwin' else 1.0 / 1024 ** 2
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+    return own, children
+
+# -------------------------
+# Benchmark
+# -------------------------
+def run_benchmark(preset='small', seed=0, out_dir=None, **pipeline_opts):
+    """
+    Simulate the preset's stacks and run svr_pipeline on them. pipeline_opts override the preset's
+    pipeline settings (and are passed on to svr_pipeline). Returns the report dict.
+    """
+    cfg = dict(PRESETS[preset])
+    sim = {k: cfg.pop(k) for k in ('size', 'n_stacks', 'thickness', 'inplane', 'rot_sd', 'trans_sd', 'noise', 'outliers')}
+    cfg.update(pipeline_opts)
+    rng = np.random.default_rng(seed)
+    out_dir = out_dir or tempfile.mkdtemp(prefix='svr_bench_')
+    os.makedirs(out_dir, exist_ok=True)
+    t0 = time.perf_counter()
+    phantom, phantom_affine = make_phantom(sim['size'])
+    stack_paths, truth = [], []
+    for i, orient in enumerate(stack_orientations(sim['n_stacks'])):
+        data, affine, motion = simulate_stack(phantom, phantom_affine, orient, sim['thickness'], sim['inplane'],
+                                              sim['rot_sd'], sim['trans_sd'], sim['noise'], rng, outliers=sim['outliers'])
+        path = os.path.join(out_dir, f'stack{i}.nii.gz')
+        nib.save(nib.Nifti1Image(data, affine), path)
+        stack_paths.append(path)
+        truth.extend(motion)
+    t_sim = time.perf_counter() - t0
+    recon_path = os.path.join(out_dir, 'recon.nii.gz')
+    stats = {}
+    t0 = time.perf_counter()
+    transforms = svr_pipeline(stack_paths, recon_path, device='cpu', stats=stats, **cfg)
+    t_total = time.perf_counter() - t0
+    rot_err, trans_err = motion_errors(transforms, truth)
+    psnr, ssim = image_metrics(recon_path, phantom, phantom_affine)
+    rss, rss_children = peak_rss_mb()
+    return {
+        'preset': preset, 'seed': seed, 'simulation': sim,
+        'pipeline': {k: list(v) if isinstance(v, tuple) else v for k, v in cfg.items()},
+        'time_simulate_s': t_sim, 'time_pipeline_s': t_total, 'time_stages_s': stats['time'],
+        'peak_rss_mb': rss, 'peak_rss_workers_mb': rss_children,
+        'n_slices': stats['n_slices'], 'n_kept': stats['n_kept'], 'n_dropped': stats['n_dropped'],
+        'rot_err_deg_mean': float(rot_err.mean()) if rot_err.size else np.nan,
+        'rot_err_deg_max': float(rot_err.max()) if rot_err.size else np.nan,
+        'trans_err_mm_mean': float(trans_err.mean()) if trans_err.size else np.nan,
+        'trans_err_mm_max': float(trans_err.max()) if trans_err.size else np.nan,
+        'psnr_db': float(psnr), 'ssim': float(ssim), 'output_dir': out_dir,
+    }
+
+def print_report(report):
+    print(f"\n=== SVR benchmark: {report['preset']} (seed {report['seed']}) ===")
+    sim = report['simulation']
+    print(f"phantom {sim['size']}^3, {sim['n_stacks']} stacks, {sim['thickness']} mm slices, "
+          f"motion sd {sim['rot_sd']} deg / {sim['trans_sd']} mm")
+    print(f"simulation        {report['time_simulate_s']:8.2f} s")
+    for stage, t in report['time_stages_s'].items():
+        print(f"  {stage:<16}{t:8.2f} s")
+    print(f"pipeline total    {report['time_pipeline_s']:8.2f} s")
+    print(f"peak RSS          {report['peak_rss_mb']:8.1f} MB (workers {report['peak_rss_workers_mb']:.1f} MB)")
+    print(f"slices kept       {report['n_kept']}/{report['n_slices']} ({report['n_dropped']} dropped)")
+    print(f"rotation error    {report['rot_err_deg_mean']:.2f} deg mean, {report['rot_err_deg_max']:.2f} max")
+    print(f"translation error {report['trans_err_mm_mean']:.2f} mm mean, {report['trans_err_mm_max']:.2f} max")
+    print(f"PSNR {report['psnr_db']:.2f} dB, SSIM {report['ssim']:.4f}")
+
+# -------------------------
+# CLI
+# -------------------------
+def parse_args():
+    p = argparse.ArgumentParser(description='Synthetic-phantom speed/accuracy benchmark for simplesvr')
+    p.add_argument('--preset', choices=sorted(PRESETS), default='small')
+    p.add_argument('--seed', type=int, default=0, help='Motion/noise random seed')
+    p.add_argument('--outdir', type=str, default=None, help='Keep stacks and reconstruction here (default: temp dir)')
+    p.add_argument('--outliers', type=float, default=None, help='Fraction of slices with a signal-dropout band (default: preset)')
+    p.add_argument('--json', type=str, default=None, help='Also write the report to this JSON file')
+    # pipeline overrides (default: the preset's settings)
+    p.add_argument('--nouter', type=int, default=None)
+    p.add_argument('--slicesteps', type=int, default=None)
+    p.add_argument('--pyramid', type=int, nargs='+', default=None)
+    p.add_argument('--optimizer', choices=['adam', 'lm'], default=None)
+    p.add_argument('--batch', type=int, default=None)
+    p.add_argument('--patience', type=int, default=None)
+    p.add_argument('--workers', type=int, default=None)
+    p.add_argument('--recon', choices=['nn', 'trilinear', 'sr'], default=None)
+    p.add_argument('--stackinit', action='store_true')
+    p.add_argument('--robust', action='store_true')
+    return p.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    overrides = {'n_outer': args.nouter, 'slice_steps': args.slicesteps, 'batch_size': args.batch,
+                 'patience': args.patience, 'workers': args.workers, 'optimizer': args.optimizer, 'recon': args.recon,
+                 'levels': tuple(args.pyramid) if args.pyramid else None, 'stack_init': args.stackinit or None,
+                 'robust': args.robust or None}
+    if args.outliers is not None:
+        PRESETS[args.preset]['outliers'] = args.outliers
+    report = run_benchmark(args.preset, seed=args.seed, out_dir=args.outdir,
+                           **{k: v for k, v in overrides.items() if v is not None})
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2, default=float)